@@ -0,0 +1,117 @@
+"""
+Догрузка исторических оплат/отмен в metrika_queue:
+    python -m app.backfill [--since 01.09.2024] [--name backfill] [--reset] [--dry-run]
+Сделки читаются потоково (crm.deal.list по страницам), после каждой страницы в той же транзакции
+сохраняется чекпоинт — повторный запуск продолжает с последнего обработанного ID.
+"""
+import argparse
+import time
+from dateutil import parser as dtparser
+from app.settings import settings, _parse_cutoff
+from app import bitrix as bx
+from app.db import (conn, get_deal_states, enqueue_many, upsert_deal_states,
+                    get_backfill_checkpoint, save_backfill_checkpoint)
+from app.logic import stage_to_event, has_required, resolve_counter, _contact_ep, _extract_client_id
+from app.metrika import build_payload, payload_hash
+from app.logger import configure_root, get_logger
+
+configure_root("backfill.log")
+log = get_logger("app.backfill")
+
+
+def iter_deal_pages(since, after_id: int = 0):
+    flt = {"STAGE_ID": settings.paid_stages + settings.cancelled_stages}
+    if since:
+        flt[">=DATE_MODIFY"] = since.isoformat()
+    yield from bx.iter_list("crm.deal.list", filter=flt, select=bx.deal_select() + ["CLOSEDATE", "DATE_MODIFY"],
+                            after_id=after_id)
+
+
+def _event_ts(deal: dict) -> int | None:
+    """
+    Время события для Метрики — когда сделка закрылась, а не день бэкфилла.
+    CLOSEDATE у открытой сделки — плановая дата (может быть в будущем), тогда берём DATE_MODIFY.
+    """
+    now = time.time()
+    for field in ("CLOSEDATE", "DATE_MODIFY"):
+        try:
+            ts = int(dtparser.parse(deal[field]).timestamp()) if deal.get(field) else None
+        except (ValueError, OverflowError):
+            ts = None
+        if ts and ts <= now:
+            return ts
+    return None
+
+
+def _build_page(page: list[dict], states: dict[int, dict], contacts: dict[int, dict]) -> tuple[list, list]:
+    """Возвращает (строки для metrika_queue, строки для deal_state)."""
+    items, state_rows = [], []
+    for deal in page:
+        deal_id = int(deal["ID"])
+        stg = bx.get_deal_stage_id(deal)
+        ev = stage_to_event(stg)
+        st = states.get(deal_id)
+        if not ev or (st and st.get("last_stage_id") == stg and st.get("last_sent_hash")):
+            continue
+        if not has_required(deal):
+            continue
+        try:
+            counter_id, token, used_uf = resolve_counter(deal, st)
+        except RuntimeError:
+            continue
+        cid = int(deal["CONTACT_ID"]) if deal.get("CONTACT_ID") else None
+        # контакты в бэкфилле не создаём и не привязываем — только уже существующие
+        extra_ep = _contact_ep(cid, contacts[cid]) if cid in contacts else {}
+        payload = build_payload(counter_id, token, _extract_client_id(deal), ev, deal, used_uf, extra_ep=extra_ep,
+                                ts=_event_ts(deal))
+        h = payload_hash(payload)
+        items.append((deal_id, ev, payload, h))
+        state_rows.append({
+            "deal_id": deal_id, "last_stage_id": stg, "last_sent_hash": h,
+            "locked_counter_id": counter_id, "locked_mp_token": token, "locked_uf_value": used_uf,
+        })
+    return items, state_rows
+
+
+def run(since, name: str = "backfill", reset: bool = False, dry_run: bool = False):
+    with conn() as c:
+        cp = None if reset else get_backfill_checkpoint(c, name)
+    last_id = int(cp["last_id"]) if cp else 0
+    processed = int(cp["processed"]) if cp else 0
+    queued = int(cp["queued"]) if cp else 0
+    log.info("backfill_started", extra={"since": str(since), "after_id": last_id, "dry_run": dry_run})
+
+    for page in iter_deal_pages(since, after_id=last_id):
+        ids = [int(d["ID"]) for d in page]
+        contacts = bx.get_contacts_light(d.get("CONTACT_ID") for d in page)
+        with conn() as c:
+            states = get_deal_states(c, ids)
+        items, state_rows = _build_page(page, states, contacts)
+        if not dry_run:
+            with conn() as c:
+                enqueue_many(c, items)
+                upsert_deal_states(c, state_rows)
+                save_backfill_checkpoint(c, name, ids[-1], processed + len(page), queued + len(items))
+        last_id = ids[-1]
+        processed += len(page)
+        queued += len(items)
+        log.info("backfill_page", extra={"last_id": last_id, "processed": processed, "queued": queued})
+
+    log.info("backfill_done", extra={"processed": processed, "queued": queued, "last_id": last_id})
+    return processed, queued
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Backfill paid/cancelled deals into metrika_queue")
+    ap.add_argument("--since", help="дата (по умолчанию PROCESS_FROM_DATE)")
+    ap.add_argument("--name", default="backfill", help="имя чекпоинта")
+    ap.add_argument("--reset", action="store_true", help="начать заново, игнорируя чекпоинт")
+    ap.add_argument("--dry-run", action="store_true", help="ничего не писать в БД")
+    args = ap.parse_args()
+    since = _parse_cutoff(args.since) if args.since else settings.process_from_date
+    processed, queued = run(since, name=args.name, reset=args.reset, dry_run=args.dry_run)
+    print(f"processed: {processed}, queued: {queued}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,95 @@
 import os
 import time
-import requests
+import threading
+from typing import TypedDict
 from requests import exceptions
+from urllib.parse import urlencode
 from app.settings import settings
 from app.logger import get_logger
+from app.sessions import get_session
+from app.cache import TTLCache
+from app.utils import normalize_phone
+from app.metrics import BX_CALL_SECONDS, BX_RATE_WAIT_SECONDS, BX_THROTTLED
+from app.ratelimit import TokenBucket, DbTokenBucket
 
 BX = settings.bitrix_webhook_url
 log = get_logger("app.bitrix")
 
 BITRIX_MAX_ATTEMPTS = int(os.getenv("BITRIX_MAX_ATTEMPTS", "3"))
+BITRIX_BATCH_MAX = 50  # лимит команд в одном batch у Битрикса
+
+# лимит REST облачного Битрикса: ~2 запроса/с на портал с небольшим burst
+BITRIX_RATE = float(os.getenv("BITRIX_RATE", "2"))
+BITRIX_BURST = float(os.getenv("BITRIX_BURST", "5"))
+BITRIX_MIN_RATE = float(os.getenv("BITRIX_MIN_RATE", "0.25"))
+BITRIX_RATE_MODE = os.getenv("BITRIX_RATE_MODE", "local").lower()  # local | db (общий для процессов)
+BITRIX_THROTTLE_RETRIES = int(os.getenv("BITRIX_THROTTLE_RETRIES", "5"))
+
+if BITRIX_RATE_MODE == "db":
+    bx_limiter = DbTokenBucket("bitrix", BITRIX_RATE, BITRIX_BURST, BITRIX_MIN_RATE)
+else:
+    bx_limiter = TokenBucket(BITRIX_RATE, BITRIX_BURST, BITRIX_MIN_RATE)
+
+# кэши контактов (здесь и app.logic.contact_identity): onCrmContactUpdate/Delete сбрасывают их только
+# в процессе, получившем webhook; в остальных процессах запись живёт до CONTACT_CACHE_TTL — это и есть
+# предел устаревания между процессами.
+CONTACT_CACHE_SIZE = int(os.getenv("CONTACT_CACHE_SIZE", "10000"))
+CONTACT_CACHE_TTL = float(os.getenv("CONTACT_CACHE_TTL", "900"))
+
+# нормализованный телефон/email/client_id -> contact_id. Удалённый контакт из кэша не привязывается:
+# путь по кэшу проверяет контакт и при неудаче идёт в обычный поиск.
+contact_ids = TTLCache("contact_ids", CONTACT_CACHE_SIZE, CONTACT_CACHE_TTL)
+
+
+def _is_throttled(r) -> bool:
+    # QUERY_LIMIT_EXCEEDED приходит с 503 — тело разбираем только тогда, обычные ответы парсятся один раз
+    if r.status_code != 503:
+        return False
+    try:
+        return r.json().get("error") == "QUERY_LIMIT_EXCEEDED"
+    except Exception:
+        return False
+
+
+# повтор по HTTP-статусу — только для чтений: запись (crm.contact.add, deal.update) могла уже выполниться
+BITRIX_RETRY_STATUSES = (429, 500, 502, 504)
+_READ_METHODS = ("crm.duplicate.findbycomm",)
+
+
+def _is_read_method(method: str) -> bool:
+    return method.endswith((".get", ".list", ".fields")) or method in _READ_METHODS
+
+
+def _is_read_call(method: str, params: dict) -> bool:
+    if method != "batch":
+        return _is_read_method(method)
+    return all(_is_read_method(str(cmd).split("?", 1)[0]) for cmd in (params.get("cmd") or {}).values())
 
 
 def bx_call(method: str, **params):
-    for attempt in range(1, BITRIX_MAX_ATTEMPTS + 1):
+    # повторы на сетевых ошибках делает адаптер сессии (app.sessions), по 5xx/429 — здесь и только для чтений;
+    # 503 QUERY_LIMIT_EXCEEDED обрабатываем здесь — через общий bx_limiter
+    session = get_session("bitrix", BITRIX_MAX_ATTEMPTS)
+    retry_status = _is_read_call(method, params)
+    failures = throttled = 0
+    while True:
+        BX_RATE_WAIT_SECONDS.observe(bx_limiter.acquire())
         try:
-            r = requests.post(f"{BX}/{method}.json", json=params, timeout=20)
+            with BX_CALL_SECONDS.labels(method).time():
+                r = session.post(f"{BX}/{method}.json", json=params, timeout=20)
         except exceptions.RequestException as e:
-            if attempt == BITRIX_MAX_ATTEMPTS:
-                log.error("bx_call_failed", extra={"method": method, "error": str(e), "attempt": attempt})
-                raise
-            log.warning("bx_call_retry", extra={"method": method, "error": str(e), "attempt": attempt})
-            time.sleep(2 ** (attempt - 1))
+            log.error("bx_call_failed", extra={"method": method, "error": str(e), "attempt": BITRIX_MAX_ATTEMPTS})
+            raise
+        if throttled < BITRIX_THROTTLE_RETRIES and _is_throttled(r):
+            throttled += 1
+            BX_THROTTLED.inc()
+            bx_limiter.throttled()
+            log.warning("bx_call_throttled", extra={"method": method, "attempt": throttled})
+            continue
+        if retry_status and r.status_code in BITRIX_RETRY_STATUSES and failures + 1 < BITRIX_MAX_ATTEMPTS:
+            failures += 1
+            log.warning("bx_call_retry", extra={"method": method, "status": r.status_code, "attempt": failures})
+            time.sleep(2 ** (failures - 1))
             continue
         try:
             r.raise_for_status()
@@ -33,36 +102,148 @@ def bx_call(method: str, **params):
             raise
 
 
-def get_deal_full(deal_id: int) -> dict:
-    return bx_call("crm.deal.get", id=deal_id)
+def _php_query(params: dict, prefix: str | None = None) -> list[tuple[str, str]]:
+    """Разворачивает вложенные параметры в PHP-стиль: fields[PHONE][0][VALUE]=..."""
+    pairs = []
+    items = params.items() if isinstance(params, dict) else enumerate(params)
+    for k, v in items:
+        key = f"{prefix}[{k}]" if prefix is not None else str(k)
+        if isinstance(v, (dict, list, tuple)):
+            pairs.extend(_php_query(v, key))
+        elif v is None:
+            pairs.append((key, ""))
+        else:
+            pairs.append((key, str(v)))
+    return pairs
 
 
-def get_deal_stage_id(deal: dict) -> str:
-    return str(deal.get("STAGE_ID") or "")
+def _batch_cmd(method: str, params: dict) -> str:
+    # $result[...] должен дойти до Битрикса как есть — иначе подстановка не сработает
+    return f"{method}?" + urlencode(_php_query(params), safe="[]$")
 
 
-def find_contact_by_comm(value: str, comm_type: str):
-    if not value:
-        return None
-    try:
-        res = bx_call("crm.duplicate.findbycomm", type=comm_type, values=[value])
-    except Exception:
-        res = bx_call("crm.duplicate.findbycomm", type=comm_type, values=[{"VALUE": value, "TYPE": comm_type}])
-    ids = res.get("CONTACT", []) or []
-    return int(ids[0]) if ids else None
+def bx_batch(commands: dict[str, tuple[str, dict]], halt: bool = False) -> tuple[dict, dict]:
+    """
+    Выполняет несколько REST-команд одним запросом к методу batch.
+    commands: {ключ: (метод, параметры)}; в параметрах можно ссылаться на результат
+    предыдущей команды через "$result[ключ]" / "$result[ключ][ПОЛЕ]".
+    Возвращает (results, errors): errors[ключ] — RuntimeError в том же формате, что и у bx_call.
+    """
+    results: dict = {}
+    errors: dict = {}
+    for chunk in _batch_chunks(commands):
+        res = bx_call("batch", halt=1 if halt else 0, cmd={k: _batch_cmd(*commands[k]) for k in chunk})
+        if not _collect_batch(commands, chunk, res, results, errors, halt):
+            break
+    return results, errors
 
 
-def find_contact_by_uf_client_id(client_id: str | None, uf_code: str | None):
-    if not (client_id and uf_code):
-        return None
-    res = bx_call("crm.contact.list", filter={uf_code: str(client_id)}, select=["ID"])
-    if isinstance(res, list) and res and res[0].get("ID"):
-        return int(res[0]["ID"])
-    return None
+def _batch_chunks(commands: dict) -> list[list[str]]:
+    keys = list(commands)
+    return [keys[i:i + BITRIX_BATCH_MAX] for i in range(0, len(keys), BITRIX_BATCH_MAX)]
+
+
+def _collect_batch(commands: dict, chunk: list[str], res: dict, results: dict, errors: dict, halt: bool) -> bool:
+    """Раскладывает ответ batch по results/errors; False — дальше не идём (halt и есть ошибки)."""
+    ok = res.get("result") or {}
+    failed = res.get("result_error") or {}
+    for k in chunk:
+        if k in failed:
+            err = failed[k] if isinstance(failed[k], dict) else {"error": failed[k]}
+            method = commands[k][0]
+            errors[k] = RuntimeError(f"{method}: {err.get('error')}: {err.get('error_description')}")
+        elif k in ok:
+            results[k] = ok[k]
+    if failed:
+        log.warning("bx_batch_errors", extra={"commands": list(failed), "halt": halt})
+    return not (halt and failed)
+
+
+class DealRecord(TypedDict, total=False):
+    """Проекция сделки (deal_select); UF-поля из settings лежат под своими кодами."""
+    ID: str
+    TITLE: str
+    STAGE_ID: str
+    CONTACT_ID: str | None
+    OPPORTUNITY: str
+    CURRENCY_ID: str
+    client_id: str
+
+
+# поля, которые читает сам код: logic/metrika (стадия, сумма, client_id) и поиск контакта (телефон/email)
+DEAL_FIELDS = ["ID", "TITLE", "STAGE_ID", "CONTACT_ID", "OPPORTUNITY", "CURRENCY_ID", "client_id",
+               "PHONE", "EMAIL", "UF_CRM_PHONE", "UF_CRM_EMAIL"]
+
+
+def deal_select() -> list[str]:
+    fields = DEAL_FIELDS + [settings.uf_client_id_deal, settings.uf_routing_field, settings.uf_required,
+                            *settings.deal_select_extra]
+    return list(dict.fromkeys(f for f in fields if f))
+
+
+def _deal_from_list(rows, deal_id: int) -> DealRecord:
+    if not rows:
+        raise RuntimeError(f"crm.deal.list: NOT_FOUND: deal {deal_id} not found")
+    return rows[0]
+
+
+def get_deal_with_contact(deal_id: int) -> tuple[DealRecord, dict | None]:
+    """
+    Сделка + её контакт (и, если ещё не в кэше, enum-поля маршрутизации) за один batch.
+    Контакт = None, если у сделки его нет или он не прочитался.
+    """
+    commands, enum_fields = _deal_with_contact_cmds(deal_id)
+    return _deal_with_contact_result(*bx_batch(commands), enum_fields, deal_id)
+
+
+def _deal_with_contact_cmds(deal_id: int) -> tuple[dict, list[str]]:
+    commands = {
+        "deal": ("crm.deal.list", {"filter": {"ID": deal_id}, "select": deal_select(), "start": -1}),
+        "contact": ("crm.contact.get", {"id": "$result[deal][0][CONTACT_ID]"}),
+    }
+    enum_fields = list(dict.fromkeys(
+        f for f in (settings.uf_routing_field, settings.uf_required) if f and f not in enum_cache))
+    for n, code in enumerate(enum_fields):
+        commands[f"uf{n}"] = ("crm.deal.userfield.get", {"id": code})
+    return commands, enum_fields
+
+
+def _deal_with_contact_result(results: dict, errors: dict, enum_fields: list[str],
+                              deal_id: int) -> tuple[DealRecord, dict | None]:
+    if "deal" in errors:
+        log.error("bx_call_failed", extra={"method": "crm.deal.list", "error": str(errors["deal"])})
+        raise errors["deal"]
+    deal = _deal_from_list(results.get("deal"), deal_id)
+    for n, code in enumerate(enum_fields):
+        if f"uf{n}" in results:
+            enum_cache.put(code, _enum_map_from_uf(results[f"uf{n}"]))
+    contact = results.get("contact")
+    return deal, (_contact_light(contact) if contact else None)
+
+
+def iter_list(method: str, filter: dict | None = None, select: list[str] | None = None, after_id: int = 0):
+    """
+    Постранично отдаёт элементы метода *.list (по 50): keyset по ID вместо start-offset,
+    start=-1 отключает подсчёт total — страницы одинаково быстрые на любой глубине.
+    """
+    last_id = after_id
+    while True:
+        page = bx_call(method, filter={**(filter or {}), ">ID": last_id}, select=select or ["*"],
+                       order={"ID": "ASC"}, start=-1)
+        if not page:
+            return
+        yield page
+        last_id = int(page[-1]["ID"])
+        if len(page) < BITRIX_BATCH_MAX:
+            return
+
+
+def get_deal_stage_id(deal: dict) -> str:
+    return str(deal.get("STAGE_ID") or "")
 
 
-def create_contact(name: str, phone: str | None, email: str | None,
-                   client_id: str | None, uf_client_id_contact: str | None):
+def _contact_fields(name: str, phone: str | None, email: str | None,
+                    client_id: str | None, uf_client_id_contact: str | None) -> dict:
     fields = {"NAME": name or "Клиент", "OPENED": "Y"}
     if phone:
         fields["PHONE"] = [{"VALUE": phone, "VALUE_TYPE": "WORK"}]
@@ -71,12 +252,7 @@ def create_contact(name: str, phone: str | None, email: str | None,
     # если в Битриксе для client_id используется UF-поле контакта — сохраним туда
     if uf_client_id_contact and client_id:
         fields[uf_client_id_contact] = str(client_id)
-    cid = int(bx_call("crm.contact.add", fields=fields))
-    return cid
-
-
-def link_contact_to_deal(deal_id: int, contact_id: int):
-    bx_call("crm.deal.update", id=deal_id, fields={"CONTACT_ID": contact_id})
+    return fields
 
 
 def extract_first_nonempty(entity: dict, keys: list[str]) -> str | None:
@@ -90,44 +266,151 @@ def extract_first_nonempty(entity: dict, keys: list[str]) -> str | None:
     return None
 
 
-def ensure_contact_for_deal(deal: dict) -> int | None:
+def resolve_contact(deal: dict, contact: dict | None = None) -> tuple[int | None, dict | None]:
     """
-    Находит/создаёт контакт и привязывает его к сделке.
-    client_id теперь берём из обычного поля сделки 'client_id';
-    если его нет — из UF-поля сделки, заданного в settings.uf_client_id_deal (обратная совместимость).
+    Находит/создаёт контакт сделки и привязывает его к ней. Поиск (UF/телефон/email) и создание+привязка
+    идут batch-запросами. client_id берём из поля сделки 'client_id', иначе — из UF-поля
+    settings.uf_client_id_deal (обратная совместимость). Возвращает (contact_id, лёгкий контакт или None).
+    """
+    return run_batch_steps(_resolve_contact_steps(deal, contact))
+
+
+def run_batch_steps(steps):
     """
+    Выполняет шаги-генератор: генератор отдаёт (commands, halt) для bx_batch и получает (results, errors).
+    Так одна и та же логика работает и с bx_batch, и с асинхронным abx_batch (app.bitrix_async).
+    """
+    try:
+        req = next(steps)
+        while True:
+            req = steps.send(bx_batch(*req))
+    except StopIteration as stop:
+        return stop.value
+
+
+def _resolve_contact_steps(deal: dict, contact: dict | None):
     if deal.get("CONTACT_ID"):
         try:
-            return int(deal["CONTACT_ID"])
+            return int(deal["CONTACT_ID"]), contact
         except Exception:
-            return None
+            return None, None
 
+    deal_id = int(deal["ID"])
     phone = extract_first_nonempty(deal, ["PHONE", "UF_CRM_PHONE"])
     email = extract_first_nonempty(deal, ["EMAIL", "UF_CRM_EMAIL"])
-
     # ✅ ключевая правка: сперва обычное поле client_id, затем — старое UF-поле из настроек
     client_id = str(deal.get("client_id") or deal.get(settings.uf_client_id_deal) or "").strip()
 
+    keys = _contact_cache_keys(phone, email, client_id)
+    cached = contact_ids.get(keys[0][1]) if keys else None
+    if cached:
+        # кэш проверяем только по самому приоритетному признаку — как и порядок поиска ниже
+        light = yield from _link_cached(deal_id, cached)
+        if light is not None:
+            log.info("contact_linked_cached", extra={"deal_id": deal.get("ID"), "contact_id": cached})
+            return cached, light
+        # контакт удалён/недоступен (или привязка не прошла) — выкидываем из кэша и ищем заново
+        n = contact_ids.pop_values(cached)
+        log.warning("contact_cache_stale", extra={"deal_id": deal.get("ID"), "contact_id": cached, "lookup_keys": n})
+    keys = dict(keys)
+
+    lookups = {}
     if settings.uf_client_id_contact and client_id:
-        cid = find_contact_by_uf_client_id(client_id, settings.uf_client_id_contact)
-        if cid:
-            link_contact_to_deal(int(deal["ID"]), cid)
-            log.info("contact_linked_by_uf", extra={"deal_id": deal.get("ID"), "contact_id": cid})
-            return cid
-
-    contact_id = None
+        lookups["by_uf"] = ("crm.contact.list", {"filter": {settings.uf_client_id_contact: client_id}, "select": ["ID"]})
     if phone:
-        contact_id = find_contact_by_comm(phone, "PHONE")
-    if not contact_id and email:
-        contact_id = find_contact_by_comm(email, "EMAIL")
+        lookups["by_phone"] = ("crm.duplicate.findbycomm", {"type": "PHONE", "values": [phone]})
+    if email:
+        lookups["by_email"] = ("crm.duplicate.findbycomm", {"type": "EMAIL", "values": [email]})
+    found, errors = (yield lookups, False) if lookups else ({}, {})
+
+    if "by_uf" in errors:
+        raise errors["by_uf"]
+    res = found.get("by_uf")
+    if isinstance(res, list) and res and res[0].get("ID"):
+        cid = int(res[0]["ID"])
+        contact_ids.set(keys["by_uf"], cid)
+        light = yield from _link_and_get(deal_id, cid)
+        log.info("contact_linked_by_uf", extra={"deal_id": deal.get("ID"), "contact_id": cid})
+        return cid, light
 
-    if not contact_id:
+    contact_id = None
+    for key, value, comm_type in (("by_phone", phone, "PHONE"), ("by_email", email, "EMAIL")):
+        if contact_id or not value:
+            continue
+        if key in errors:
+            # портал не принял values строками — повторяем в старом формате [{VALUE, TYPE}]
+            retry, retry_errors = yield {key: ("crm.duplicate.findbycomm",
+                                               {"type": comm_type, "values": [{"VALUE": value, "TYPE": comm_type}]})}, False
+            if key in retry_errors:
+                raise retry_errors[key]
+            found[key] = retry.get(key)
+        ids = (found.get(key) or {}).get("CONTACT", []) or []
+        contact_id = int(ids[0]) if ids else None
+        if contact_id and key in keys:
+            contact_ids.set(keys[key], contact_id)
+
+    if contact_id:
+        light = yield from _link_and_get(deal_id, contact_id)
+    else:
         title = (deal.get("TITLE") or "Клиент").strip()
-        contact_id = create_contact(title, phone, email, client_id or None, settings.uf_client_id_contact)
+        contact_id = yield from _create_and_link(deal_id, title, phone, email, client_id or None,
+                                                 settings.uf_client_id_contact)
+        light = {"ID": contact_id, "PHONE": phone, "EMAIL": email}
+        for ck in keys.values():
+            contact_ids.set(ck, contact_id)
 
-    link_contact_to_deal(int(deal["ID"]), contact_id)
     log.info("contact_linked", extra={"deal_id": deal.get("ID"), "contact_id": contact_id})
-    return contact_id
+    return contact_id, light
+
+
+def _contact_cache_keys(phone: str | None, email: str | None, client_id: str) -> list[tuple[str, tuple]]:
+    """Ключи кэша contact_ids в порядке приоритета поиска: UF client_id, телефон, email."""
+    keys = []
+    if settings.uf_client_id_contact and client_id:
+        keys.append(("by_uf", ("client_id", client_id)))
+    if normalize_phone(phone or ""):
+        keys.append(("by_phone", ("phone", normalize_phone(phone))))
+    if (email or "").strip():
+        keys.append(("by_email", ("email", email.strip().lower())))
+    return keys
+
+
+def _link_and_get(deal_id: int, contact_id: int):
+    results, errors = yield {
+        "link": ("crm.deal.update", {"id": deal_id, "fields": {"CONTACT_ID": contact_id}}),
+        "contact": ("crm.contact.get", {"id": contact_id}),
+    }, False
+    if "link" in errors:
+        raise errors["link"]
+    c = results.get("contact")
+    return _contact_light(c) if c else None
+
+
+def _link_cached(deal_id: int, contact_id: int):
+    """
+    Привязка контакта из кэша: сначала читаем контакт, привязываем — ссылкой на прочитанный ID (halt),
+    так удалённый контакт не привяжется. None — путь по кэшу не удался.
+    """
+    results, errors = yield {
+        "contact": ("crm.contact.get", {"id": contact_id}),
+        "link": ("crm.deal.update", {"id": deal_id, "fields": {"CONTACT_ID": "$result[contact][ID]"}}),
+    }, True
+    c = results.get("contact")
+    if errors or not c or "link" not in results:
+        return None
+    return _contact_light(c)
+
+
+def _create_and_link(deal_id: int, name: str, phone: str | None, email: str | None,
+                     client_id: str | None, uf_client_id_contact: str | None):
+    results, errors = yield {
+        "contact": ("crm.contact.add", {"fields": _contact_fields(name, phone, email, client_id, uf_client_id_contact)}),
+        "link": ("crm.deal.update", {"id": deal_id, "fields": {"CONTACT_ID": "$result[contact]"}}),
+    }, True
+    for key in ("contact", "link"):
+        if key in errors:
+            raise errors[key]
+    return int(results["contact"])
 
 
 def _first_comm(v):
@@ -136,8 +419,7 @@ def _first_comm(v):
     return None
 
 
-def get_contact_light(contact_id: int) -> dict:
-    c = bx_call("crm.contact.get", id=contact_id)
+def _contact_light(c: dict) -> dict:
     return {
         "ID": int(c.get("ID") or 0),
         "PHONE": _first_comm(c.get("PHONE")),
@@ -145,6 +427,17 @@ def get_contact_light(contact_id: int) -> dict:
     }
 
 
+def get_contact_light(contact_id: int) -> dict:
+    return _contact_light(bx_call("crm.contact.get", id=contact_id))
+
+
+def get_contacts_light(contact_ids) -> dict[int, dict]:
+    """Несколько контактов batch-запросами; не прочитавшиеся просто отсутствуют в ответе."""
+    ids = list(dict.fromkeys(int(i) for i in contact_ids if i))
+    results, _ = bx_batch({f"c{cid}": ("crm.contact.get", {"id": cid}) for cid in ids})
+    return {cid: _contact_light(results[f"c{cid}"]) for cid in ids if results.get(f"c{cid}")}
+
+
 def event_bind(event: str, handler: str):
     return bx_call("event.bind", event=event, handler=handler)
 
@@ -153,13 +446,12 @@ def event_unbind(event: str, handler: str):
     return bx_call("event.unbind", event=event, handler=handler)
 
 
-_enum_cache = {}
+ENUM_CACHE_TTL = float(os.getenv("ENUM_CACHE_TTL", "600"))
+# не чаще раза в N секунд перечитываем поле при неизвестном enum ID
+ENUM_MISS_REFRESH_SEC = float(os.getenv("ENUM_MISS_REFRESH_SEC", "30"))
 
 
-def _load_enum_map(field_code: str) -> dict[int, str]:
-    if field_code in _enum_cache:
-        return _enum_cache[field_code]
-    uf = bx_call("crm.deal.userfield.get", id=field_code)
+def _enum_map_from_uf(uf: dict) -> dict[int, str]:
     mapping: dict[int, str] = {}
     for item in uf.get("LIST", []) or []:
         try:
@@ -168,10 +460,97 @@ def _load_enum_map(field_code: str) -> dict[int, str]:
             continue
         xml_id = (item.get("XML_ID") or item.get("VALUE") or "").strip()
         mapping[enum_id] = xml_id
-    _enum_cache[field_code] = mapping
     return mapping
 
 
+class EnumCache:
+    """
+    Кэш enum-значений UF-полей сделки (ID -> XML_ID/VALUE).
+    - устаревшее (старше ttl) значение отдаём сразу и перечитываем в фоне;
+    - параллельные загрузки одного поля схлопываются в один запрос (single-flight);
+    - неизвестный enum ID вызывает принудительное перечитывание поля.
+    """
+
+    def __init__(self, ttl: float, miss_refresh: float):
+        self.ttl = ttl
+        self.miss_refresh = miss_refresh
+        self._maps: dict[str, dict[int, str]] = {}
+        self._loaded_at: dict[str, float] = {}
+        self._inflight: dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.forced = 0
+
+    def __contains__(self, code: str) -> bool:
+        return code in self._maps
+
+    def put(self, code: str, mapping: dict[int, str]):
+        with self._lock:
+            self._maps[code] = mapping
+            self._loaded_at[code] = time.monotonic()
+
+    def age(self, code: str) -> float | None:
+        at = self._loaded_at.get(code)
+        return time.monotonic() - at if at is not None else None
+
+    def get(self, code: str) -> dict[int, str]:
+        m = self._maps.get(code)
+        if m is None:
+            return self._load(code)
+        if self.age(code) > self.ttl and code not in self._inflight:
+            threading.Thread(target=self._refresh_quietly, args=(code,), daemon=True,
+                             name=f"enum-refresh-{code}").start()
+        return m
+
+    def needs_load(self, code: str, enum_id: int) -> bool:
+        """lookup(code, enum_id) сейчас пошёл бы в Битрикс синхронно."""
+        m = self._maps.get(code)
+        return m is None or (enum_id not in m and self.age(code) > self.miss_refresh)
+
+    def lookup(self, code: str, enum_id: int) -> str | None:
+        m = self.get(code)
+        if enum_id not in m and self.age(code) > self.miss_refresh:
+            self.forced += 1
+            log.info("enum_miss_refresh", extra={"field": code, "enum_id": enum_id})
+            m = self._load(code)
+        return m.get(enum_id)
+
+    def preload(self, codes):
+        for code in dict.fromkeys(c for c in codes if c):
+            self._refresh_quietly(code)
+
+    def _refresh_quietly(self, code: str):
+        try:
+            self._load(code)
+        except Exception as e:
+            log.warning("enum_refresh_failed", extra={"field": code, "error": str(e)})
+
+    def _load(self, code: str) -> dict[int, str]:
+        with self._lock:
+            ev = self._inflight.get(code)
+            leader = ev is None
+            if leader:
+                ev = self._inflight[code] = threading.Event()
+        if not leader:
+            ev.wait(30)
+            if code in self._maps:
+                return self._maps[code]
+            raise RuntimeError(f"enum map for {code} is not loaded")
+        try:
+            mapping = _enum_map_from_uf(bx_call("crm.deal.userfield.get", id=code))
+            self.put(code, mapping)
+            self.loads += 1
+            log.info("enum_loaded", extra={"field": code, "count": len(mapping)})
+            return mapping
+        finally:
+            with self._lock:
+                self._inflight.pop(code, None)
+            ev.set()
+
+
+enum_cache = EnumCache(ENUM_CACHE_TTL, ENUM_MISS_REFRESH_SEC)
+
+
 from urllib.parse import urlparse
 
 def _to_host(val: str) -> str:
@@ -201,8 +580,7 @@ def routing_value_from_deal(deal: dict, field_code: str) -> str:
     # если это enum (число) — вытаскиваем XML_ID/значение как раньше
     try:
         enum_id = int(val)
-        m = _load_enum_map(field_code)
-        return _to_host(m.get(enum_id) or "")
+        return _to_host(enum_cache.lookup(field_code, enum_id) or "")
     except Exception:
         # иначе строка
         return _to_host(str(val))
@@ -0,0 +1,104 @@
+"""
+Асинхронные варианты bx_call / bx_batch / get_deal_with_contact / resolve_contact (httpx).
+Логика, кэши и лимитер общие с app.bitrix — здесь только ввод-вывод.
+"""
+import asyncio
+import httpx
+from app import bitrix as bx
+from app.bitrix import (BX, BITRIX_MAX_ATTEMPTS, BITRIX_THROTTLE_RETRIES, BITRIX_RETRY_STATUSES, BITRIX_RATE_MODE,
+                        bx_limiter, enum_cache, log, _enum_map_from_uf,
+                        _batch_cmd, _batch_chunks, _collect_batch, _is_throttled, _is_read_call,
+                        _deal_with_contact_cmds, _deal_with_contact_result, _resolve_contact_steps)
+from app.settings import settings
+from app.sessions import get_async_client
+from app.metrics import BX_CALL_SECONDS, BX_RATE_WAIT_SECONDS, BX_THROTTLED
+
+
+async def abx_call(method: str, **params):
+    client = get_async_client("bitrix", BITRIX_MAX_ATTEMPTS, timeout=20)
+    retry_status = _is_read_call(method, params)
+    failures = throttled = 0
+    while True:
+        # в режиме db резерв токена — транзакция в БД: не в event loop
+        wait = await asyncio.to_thread(bx_limiter.reserve) if BITRIX_RATE_MODE == "db" else bx_limiter.reserve()
+        BX_RATE_WAIT_SECONDS.observe(wait)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        try:
+            with BX_CALL_SECONDS.labels(method).time():
+                r = await client.post(f"{BX}/{method}.json", json=params)
+        except httpx.HTTPError as e:
+            failures += 1
+            if failures >= BITRIX_MAX_ATTEMPTS:
+                log.error("bx_call_failed", extra={"method": method, "error": str(e), "attempt": failures})
+                raise
+            log.warning("bx_call_retry", extra={"method": method, "error": str(e), "attempt": failures})
+            await asyncio.sleep(2 ** (failures - 1))
+            continue
+        if throttled < BITRIX_THROTTLE_RETRIES and _is_throttled(r):
+            throttled += 1
+            BX_THROTTLED.inc()
+            bx_limiter.throttled()
+            log.warning("bx_call_throttled", extra={"method": method, "attempt": throttled})
+            continue
+        if retry_status and r.status_code in BITRIX_RETRY_STATUSES and failures + 1 < BITRIX_MAX_ATTEMPTS:
+            failures += 1
+            log.warning("bx_call_retry", extra={"method": method, "status": r.status_code, "attempt": failures})
+            await asyncio.sleep(2 ** (failures - 1))
+            continue
+        try:
+            r.raise_for_status()
+            data = r.json()
+            if "error" in data:
+                raise RuntimeError(f"{method}: {data['error']}: {data.get('error_description')}")
+            return data["result"]
+        except Exception as e:
+            log.error("bx_call_failed", extra={"method": method, "error": str(e)})
+            raise
+
+
+async def abx_batch(commands: dict[str, tuple[str, dict]], halt: bool = False) -> tuple[dict, dict]:
+    results: dict = {}
+    errors: dict = {}
+    for chunk in _batch_chunks(commands):
+        res = await abx_call("batch", halt=1 if halt else 0, cmd={k: _batch_cmd(*commands[k]) for k in chunk})
+        if not _collect_batch(commands, chunk, res, results, errors, halt):
+            break
+    return results, errors
+
+
+async def arun_batch_steps(steps):
+    """Асинхронный аналог bx.run_batch_steps."""
+    try:
+        req = next(steps)
+        while True:
+            req = steps.send(await abx_batch(*req))
+    except StopIteration as stop:
+        return stop.value
+
+
+async def aget_deal_with_contact(deal_id: int) -> tuple[bx.DealRecord, dict | None]:
+    commands, enum_fields = _deal_with_contact_cmds(deal_id)
+    return _deal_with_contact_result(*await abx_batch(commands), enum_fields, deal_id)
+
+
+async def aresolve_contact(deal: dict, contact: dict | None = None) -> tuple[int | None, dict | None]:
+    return await arun_batch_steps(_resolve_contact_steps(deal, contact))
+
+
+async def aensure_enums(deal: dict):
+    """
+    Догружает enum-поля маршрутизации, которые routing_value_from_deal иначе прочитал бы синхронным
+    bx_call (с time.sleep лимитера и ожиданием single-flight) прямо в event loop.
+    """
+    for code in dict.fromkeys(c for c in (settings.uf_routing_field, settings.uf_required) if c):
+        try:
+            enum_id = int(deal.get(code))
+        except (TypeError, ValueError):
+            continue
+        if enum_cache.needs_load(code, enum_id):
+            enum_cache.put(code, _enum_map_from_uf(await abx_call("crm.deal.userfield.get", id=code)))
+
+
+async def aget_contact_light(contact_id: int) -> dict:
+    return bx._contact_light(await abx_call("crm.contact.get", id=contact_id))
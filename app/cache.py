@@ -0,0 +1,86 @@
+import time
+import threading
+from collections import OrderedDict
+
+_registry: dict = {}
+
+
+class TTLCache:
+    """Потокобезопасный LRU-кэш с TTL и счётчиками попаданий/промахов."""
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        _registry[name] = self
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value, ttl: float | None = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def compute(self, key, fn, ttl: float | None = None):
+        """Атомарно: новое значение = fn(текущее или None); если fn вернула None — ключ не меняется."""
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            value = fn(item[1] if item is not None and item[0] >= now else None)
+            if value is None:
+                return None
+            self._data[key] = (now + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            return value
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item[1] if item else None
+
+    def pop_values(self, value) -> int:
+        """Удаляет все ключи, указывающие на value (обратная инвалидация)."""
+        with self._lock:
+            keys = [k for k, (_, v) in self._data.items() if v == value]
+            for k in keys:
+                del self._data[k]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+
+def cache_stats() -> dict[str, dict]:
+    return {name: c.stats() for name, c in list(_registry.items())}
@@ -1,64 +1,224 @@
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, text, bindparam, event
 from sqlalchemy.engine import Engine
 from contextlib import contextmanager
 from app.settings import settings
+from app.metrics import DB_QUERY_SECONDS
+from app.cache import TTLCache
+import os
 import json
+import time
+import itertools
 
 engine: Engine = create_engine(settings.database_url, pool_pre_ping=True, future=True)
 
+@event.listens_for(engine, "before_cursor_execute")
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+@event.listens_for(engine, "after_cursor_execute")
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    op = (statement.split(None, 1) or ["?"])[0].upper()
+    DB_QUERY_SECONDS.labels(op).observe(time.perf_counter() - started)
+
+# кэш строк deal_state: read-through в get_deal_state, write-through из upsert_deal_state(s) после коммита.
+# Между процессами не синхронизируется, а быстрый путь по стадии доверяет ему без БД — поэтому по умолчанию
+# выключен (0). Включать, только если webhook обрабатывает один процесс. Проверка дублей при записи
+# (lock_deal_state) кэшу не доверяет в любом случае.
+DEAL_STATE_CACHE_TTL = float(os.getenv("DEAL_STATE_CACHE_TTL", "0"))
+deal_state_cache = TTLCache("deal_state", int(os.getenv("DEAL_STATE_CACHE_SIZE", "10000")), DEAL_STATE_CACHE_TTL)
+# версия записи: номер выдаётся после UPSERT, когда строка уже заблокирована, т.е. в порядке применения в БД
+_state_seq = itertools.count(1)
+_LOCKED = ("locked_counter_id", "locked_mp_token", "locked_uf_value")
+
+
+def _cache_fill(deal_id: int, row: dict):
+    if DEAL_STATE_CACHE_TTL <= 0:
+        return
+    # прочитанное не перетирает ничего: запись из коммита новее любого чтения (или равна ему)
+    deal_state_cache.compute(deal_id, lambda cur: None if cur else (0, dict(row)))
+
+
+def _cache_write(seq: int, row: dict):
+    if DEAL_STATE_CACHE_TTL <= 0:
+        return
+
+    def merge(cur):
+        if cur and cur[0] > seq:
+            return None  # уже есть более поздняя запись
+        base = cur[1] if cur else None
+        if base is None and any(row.get(k) is None for k in _LOCKED):
+            return None  # locked_* в БД могли быть заданы раньше (IFNULL) — не знаем их, не кэшируем
+        new = dict(base or {})
+        new.update({k: v for k, v in row.items() if k not in _LOCKED})
+        for k in _LOCKED:
+            new[k] = new.get(k) if new.get(k) is not None else row.get(k)
+        return seq, new
+
+    deal_state_cache.compute(row["deal_id"], merge)
+
+
+def cached_deal_state(deal_id: int) -> dict | None:
+    """Строка deal_state из кэша без обращения к БД; None — нет в кэше."""
+    cur = deal_state_cache.get(deal_id)
+    return dict(cur[1]) if cur else None
+
+
 @contextmanager
 def conn():
+    # записи deal_state копятся в транзакции и попадают в кэш только после успешного коммита
+    pending = []
     with engine.begin() as c:
-        yield c
+        c.info["deal_state_writes"] = pending
+        try:
+            yield c
+        finally:
+            c.info.pop("deal_state_writes", None)
+    for seq, row in pending:
+        _cache_write(seq, row)
 
 def get_deal_state(c, deal_id: int) -> dict | None:
+    cached = cached_deal_state(deal_id)
+    if cached is not None:
+        return cached
     r = c.execute(text("SELECT * FROM deal_state WHERE deal_id=:id"), {"id": deal_id}).mappings().first()
+    if r:
+        _cache_fill(deal_id, dict(r))
     return dict(r) if r else None
 
+def lock_deal_state(c, deal_id: int) -> dict | None:
+    """
+    Строка deal_state из БД под блокировкой до конца транзакции — мимо кэша: другой процесс мог
+    изменить её после того, как мы её закэшировали. Прочитанное обновляет кэш этого процесса.
+    """
+    r = c.execute(text("SELECT * FROM deal_state WHERE deal_id=:id FOR UPDATE"), {"id": deal_id}).mappings().first()
+    if r is None:
+        deal_state_cache.pop(deal_id)
+        return None
+    row = dict(r)
+    if DEAL_STATE_CACHE_TTL > 0:
+        # строка заблокирована: все записи, закоммиченные до нас, получили номер раньше
+        seq = next(_state_seq)
+        deal_state_cache.compute(deal_id, lambda cur: None if cur and cur[0] > seq else (seq, dict(row)))
+    return row
+
+_UPSERT_DEAL_STATE = text("""
+    INSERT INTO deal_state
+      (deal_id, last_stage_id, last_sent_hash, locked_counter_id, locked_mp_token, locked_uf_value, updated_at)
+    VALUES
+      (:deal_id, :last_stage_id, :last_sent_hash, :locked_counter_id, :locked_mp_token, :locked_uf_value, NOW())
+    ON DUPLICATE KEY UPDATE
+      last_stage_id = VALUES(last_stage_id),
+      last_sent_hash = VALUES(last_sent_hash),
+      locked_counter_id = IFNULL(locked_counter_id, VALUES(locked_counter_id)),
+      locked_mp_token = IFNULL(locked_mp_token, VALUES(locked_mp_token)),
+      locked_uf_value = IFNULL(locked_uf_value, VALUES(locked_uf_value)),
+      updated_at = NOW()
+""")
+
 def upsert_deal_state(c, **kwargs):
-    q = text("""
-        INSERT INTO deal_state
-          (deal_id, last_stage_id, last_sent_hash, locked_counter_id, locked_mp_token, locked_uf_value, updated_at)
-        VALUES
-          (:deal_id, :last_stage_id, :last_sent_hash, :locked_counter_id, :locked_mp_token, :locked_uf_value, NOW())
-        ON DUPLICATE KEY UPDATE
-          last_stage_id = VALUES(last_stage_id),
-          last_sent_hash = VALUES(last_sent_hash),
-          locked_counter_id = IFNULL(locked_counter_id, VALUES(locked_counter_id)),
-          locked_mp_token = IFNULL(locked_mp_token, VALUES(locked_mp_token)),
-          locked_uf_value = IFNULL(locked_uf_value, VALUES(locked_uf_value)),
-          updated_at = NOW()
-    """)
-    c.execute(q, kwargs)
-
-def update_last_hash(c, deal_id: int, h: str):
-    c.execute(text("UPDATE deal_state SET last_sent_hash=:h, updated_at=NOW() WHERE deal_id=:id"),
-              {"h": h, "id": deal_id})
-
-def enqueue(c, deal_id: int, event_type: str, payload: dict):
+    c.execute(_UPSERT_DEAL_STATE, kwargs)
+    _defer_cache_write(c, [kwargs])
+
+def upsert_deal_states(c, rows: list[dict]):
+    if rows:
+        c.execute(_UPSERT_DEAL_STATE, rows)
+        _defer_cache_write(c, rows)
+
+def _defer_cache_write(c, rows: list[dict]):
+    pending = c.info.get("deal_state_writes")
+    for row in rows:
+        if pending is None:
+            # соединение не из conn()/aconn() — момент коммита неизвестен, просто сбрасываем запись
+            deal_state_cache.pop(row["deal_id"])
+        else:
+            pending.append((next(_state_seq), dict(row)))
+
+_ENQUEUE = text("""
+    INSERT IGNORE INTO metrika_queue (deal_id, event_type, payload, payload_hash, dedup_hash, status)
+    VALUES (:deal_id, :event_type, :payload, :h, :h, 'queued')
+""")
+
+def enqueue(c, deal_id: int, event_type: str, payload: dict, h: str) -> bool:
+    """
+    False — такое же событие (deal_id, event_type, хэш) уже ждёт отправки. Параллельная вставка
+    того же ключа ждёт на уникальном индексе до коммита первой и тоже получает False.
+    """
+    r = c.execute(_ENQUEUE, {"deal_id": deal_id, "event_type": event_type, "h": h,
+                             "payload": json.dumps(payload, ensure_ascii=False)})
+    return r.rowcount > 0
+
+def get_deal_states(c, deal_ids: list[int]) -> dict[int, dict]:
+    if not deal_ids:
+        return {}
+    rows = c.execute(text("SELECT * FROM deal_state WHERE deal_id IN :ids")
+                     .bindparams(bindparam("ids", expanding=True)), {"ids": list(deal_ids)}).mappings()
+    return {int(r["deal_id"]): dict(r) for r in rows}
+
+def enqueue_many(c, items: list[tuple[int, str, dict, str]]):
+    """Многострочная вставка в metrika_queue (executemany -> один INSERT ... VALUES (...), (...)); дубли пропускаются."""
+    if not items:
+        return
+    c.execute(_ENQUEUE, [{"deal_id": d, "event_type": e, "h": h, "payload": json.dumps(p, ensure_ascii=False)}
+                         for d, e, p, h in items])
+
+def get_backfill_checkpoint(c, name: str) -> dict | None:
+    r = c.execute(text("SELECT * FROM backfill_checkpoint WHERE name=:n"), {"n": name}).mappings().first()
+    return dict(r) if r else None
+
+def save_backfill_checkpoint(c, name: str, last_id: int, processed: int, queued: int):
     c.execute(text("""
-        INSERT INTO metrika_queue (deal_id, event_type, payload, status)
-        VALUES (:deal_id, :event_type, :payload, 'queued')
-    """), {"deal_id": deal_id, "event_type": event_type, "payload": json.dumps(payload, ensure_ascii=False)})
+        INSERT INTO backfill_checkpoint (name, last_id, processed, queued)
+        VALUES (:n, :last_id, :processed, :queued)
+        ON DUPLICATE KEY UPDATE last_id=VALUES(last_id), processed=VALUES(processed), queued=VALUES(queued)
+    """), {"n": name, "last_id": last_id, "processed": processed, "queued": queued})
 
-def fetch_queue_batch(c, limit: int = 50):
-    return list(c.execute(text("""
+def claim_queue_batch(c, worker_id: str, limit: int = 50, lease_sec: int = 300):
+    """
+    Атомарно забирает пачку в аренду: строки, захваченные другим воркером, пропускаются (SKIP LOCKED),
+    просроченная аренда (упавший воркер) снова доступна. Берём только самое раннее queued-событие
+    сделки — так порядок событий одной сделки сохраняется и между процессами.
+    """
+    rows = list(c.execute(text("""
         SELECT id, deal_id, event_type, payload, status, attempts, last_error, created_at, sent_at
-        FROM metrika_queue
-        WHERE status='queued'
-        ORDER BY id
+        FROM metrika_queue q
+        WHERE q.status='queued'
+          AND q.next_attempt_at <= NOW()
+          AND (q.lease_until IS NULL OR q.lease_until < NOW())
+          AND NOT EXISTS (
+            SELECT 1 FROM metrika_queue p
+            WHERE p.deal_id=q.deal_id AND p.status='queued' AND p.id < q.id
+          )
+        ORDER BY q.id
         LIMIT :limit
+        FOR UPDATE SKIP LOCKED
     """), {"limit": limit}).mappings())
+    if rows:
+        c.execute(text("""
+            UPDATE metrika_queue
+            SET claimed_by=:w, lease_until=NOW() + INTERVAL :lease SECOND
+            WHERE id IN :ids
+        """).bindparams(bindparam("ids", expanding=True)),
+                  {"w": worker_id, "lease": lease_sec, "ids": [r["id"] for r in rows]})
+    return rows
 
 def mark_sent(c, item_id: int):
-    c.execute(text("UPDATE metrika_queue SET status='sent', sent_at=NOW() WHERE id=:id"), {"id": item_id})
+    # dedup_hash держит уникальность только среди неотправленных строк
+    c.execute(text("""
+        UPDATE metrika_queue SET status='sent', sent_at=NOW(), lease_until=NULL, dedup_hash=NULL WHERE id=:id
+    """), {"id": item_id})
 
-def mark_error(c, item_id: int, msg: str):
+def mark_error(c, item_id: int, msg: str, retry_in: float | None = None):
+    """retry_in — через сколько секунд повторить; None — попытки исчерпаны, строка уходит в 'dead'."""
     c.execute(text("""
         UPDATE metrika_queue
-        SET status='error', attempts=attempts+1, last_error=:e
+        SET status=:status, attempts=attempts+1, last_error=:e, lease_until=NULL,
+            next_attempt_at=NOW() + INTERVAL :delay SECOND,
+            dedup_hash=IF(:status='dead', NULL, dedup_hash)
         WHERE id=:id
-    """), {"e": msg[:1000], "id": item_id})
+    """), {"e": msg[:1000], "id": item_id,
+           "status": "queued" if retry_in is not None else "dead",
+           "delay": int(retry_in or 0)})
 
 def get_routing_map(c) -> dict[str, dict]:
     rows = c.execute(text("SELECT uf_value, counter_id, mp_token FROM metrika_routing WHERE is_active=1")).mappings().all()
@@ -66,3 +226,197 @@ def get_routing_map(c) -> dict[str, dict]:
     for r in rows:
         m[str(r["uf_value"]).strip().lower()] = {"counter_id": int(r["counter_id"]), "mp_token": r["mp_token"]}
     return m
+
+def inbound_add(c, event: str, deal_id: int):
+    c.execute(text("INSERT INTO bitrix_inbound (event, deal_id, status) VALUES (:event, :deal_id, 'queued')"),
+              {"event": event, "deal_id": deal_id})
+
+def claim_inbound_batch(c, limit: int = 50, stale_sec: int = 300):
+    """
+    Забирает пачку входящих событий, срок повтора которых наступил (плюс зависшие в processing дольше
+    stale_sec), и помечает их processing.
+    Как и claim_queue_batch, голова сделки — только самое раннее незавершённое событие: пока оно не
+    обработано (или обрабатывается другим процессом), более поздние события сделки никто не берёт.
+    К захваченным головам добавляются следующие queued-события тех же сделок — для схлопывания update.
+    """
+    heads = list(c.execute(text("""
+        SELECT id, event, deal_id, attempts, received_at
+        FROM bitrix_inbound q
+        WHERE ((q.status='queued' AND q.next_attempt_at <= NOW())
+               OR (q.status='processing' AND q.claimed_at < NOW() - INTERVAL :stale SECOND))
+          AND NOT EXISTS (
+            SELECT 1 FROM bitrix_inbound p
+            WHERE p.deal_id=q.deal_id AND p.status IN ('queued', 'processing') AND p.id < q.id
+          )
+        ORDER BY q.id
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED
+    """), {"limit": limit, "stale": stale_sec}).mappings())
+    if not heads:
+        return []
+    # головы заблокированы нами, поэтому хвосты этих сделок другой процесс взять не может
+    tails = list(c.execute(text("""
+        SELECT id, event, deal_id, attempts, received_at
+        FROM bitrix_inbound
+        WHERE deal_id IN :deals AND status='queued' AND id NOT IN :ids
+        ORDER BY id
+        FOR UPDATE
+    """).bindparams(bindparam("deals", expanding=True), bindparam("ids", expanding=True)),
+        {"deals": list({r["deal_id"] for r in heads}), "ids": [r["id"] for r in heads]}).mappings())
+    rows = sorted(heads + tails, key=lambda r: r["id"])
+    c.execute(text("UPDATE bitrix_inbound SET status='processing', claimed_at=NOW() WHERE id IN :ids")
+              .bindparams(bindparam("ids", expanding=True)), {"ids": [r["id"] for r in rows]})
+    return rows
+
+def release_inbound(c, ids: list[int]):
+    """Вернуть в очередь взятые, но не обработанные события (цепочка сделки остановлена ошибкой)."""
+    if ids:
+        c.execute(text("UPDATE bitrix_inbound SET status='queued', claimed_at=NULL WHERE id IN :ids")
+                  .bindparams(bindparam("ids", expanding=True)), {"ids": ids})
+
+def purge_inbound_done(c, older_than_sec: int, limit: int = 1000) -> int:
+    r = c.execute(text("""
+        DELETE FROM bitrix_inbound
+        WHERE status='done' AND processed_at < NOW() - INTERVAL :age SECOND
+        LIMIT :limit
+    """), {"age": older_than_sec, "limit": limit})
+    return r.rowcount
+
+def mark_inbound_done(c, item_id: int):
+    c.execute(text("UPDATE bitrix_inbound SET status='done', processed_at=NOW() WHERE id=:id"), {"id": item_id})
+
+def mark_inbound_error(c, item_id: int, msg: str, retry_in: float | None = None):
+    """retry_in — через сколько секунд повторить; None — попытки исчерпаны, строка остаётся в 'error'."""
+    c.execute(text("""
+        UPDATE bitrix_inbound
+        SET status=:status, attempts=attempts+1, last_error=:e, claimed_at=NULL,
+            next_attempt_at=NOW() + INTERVAL :delay SECOND
+        WHERE id=:id
+    """), {"e": msg[:1000], "id": item_id,
+           "status": "queued" if retry_in is not None else "error",
+           "delay": int(retry_in or 0)})
+
+def get_routing_version(c) -> tuple:
+    """Дешёвый признак изменений metrika_routing: (MAX(updated_at), COUNT(*))."""
+    r = c.execute(text("SELECT MAX(updated_at) AS v, COUNT(*) AS n FROM metrika_routing")).mappings().first()
+    return (r["v"], int(r["n"])) if r else (None, 0)
+
+def get_queue_stats(c) -> dict:
+    """Только неотправленные статусы — range scan по индексу status, без прохода по 'sent'."""
+    rows = c.execute(text("""
+        SELECT status, COUNT(*) AS n, TIMESTAMPDIFF(SECOND, MIN(created_at), NOW()) AS age
+        FROM metrika_queue
+        WHERE status IN ('queued', 'dead')
+        GROUP BY status
+    """)).mappings().all()
+    depth = {"queued": 0, "dead": 0}
+    age = 0
+    for r in rows:
+        depth[r["status"]] = int(r["n"])
+        if r["status"] == "queued":
+            age = int(r["age"] or 0)
+    return {"depth": depth, "oldest_queued_age": age}
+
+def take_rate_token(c, name: str, rate: float, burst: float) -> float:
+    """
+    Резервирует один токен в общем bucket (строка блокируется до конца транзакции).
+    Возвращает остаток токенов; отрицательный — сколько «в долг», т.е. ждать -tokens/rate секунд.
+    """
+    c.execute(text("INSERT IGNORE INTO bitrix_rate_limit (name, tokens, updated_at) VALUES (:n, :b, NOW(6))"),
+              {"n": name, "b": burst})
+    r = c.execute(text("""
+        SELECT tokens, TIMESTAMPDIFF(MICROSECOND, updated_at, NOW(6)) AS elapsed_us
+        FROM bitrix_rate_limit WHERE name=:n FOR UPDATE
+    """), {"n": name}).mappings().first()
+    tokens = min(burst, float(r["tokens"]) + max(int(r["elapsed_us"] or 0), 0) / 1e6 * rate) - 1
+    c.execute(text("UPDATE bitrix_rate_limit SET tokens=:t, updated_at=NOW(6) WHERE name=:n"),
+              {"t": tokens, "n": name})
+    return tokens
+
+def add_routing_candidates(c, hosts: list[str]) -> int:
+    """Найденные хосты — неактивными строками (counter_id/mp_token заполняются вручную); существующие не трогаем."""
+    if not hosts:
+        return 0
+    r = c.execute(text("""
+        INSERT IGNORE INTO metrika_routing (uf_value, counter_id, mp_token, is_active)
+        VALUES (:h, 0, '', 0)
+    """), [{"h": h} for h in hosts])
+    return r.rowcount
+
+def archive_sent_batch(c, older_than_days: int, limit: int = 1000) -> int:
+    """
+    Переносит пачку отправленных строк старше N дней в metrika_queue_archive и удаляет их из очереди.
+    Блокируются только строки пачки (по PK), занятые строки пропускаются — горячую часть очереди не трогаем.
+    """
+    ids = [r[0] for r in c.execute(text("""
+        SELECT id FROM metrika_queue
+        WHERE status='sent' AND sent_at < NOW() - INTERVAL :days DAY
+        ORDER BY sent_at
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED
+    """), {"days": older_than_days, "limit": limit})]
+    if not ids:
+        return 0
+    c.execute(text("""
+        INSERT IGNORE INTO metrika_queue_archive
+          (id, deal_id, event_type, counter_id, payload_hash, attempts, created_at, sent_at)
+        SELECT id, deal_id, event_type, JSON_EXTRACT(payload, '$.tid'), payload_hash, attempts, created_at, sent_at
+        FROM metrika_queue WHERE id IN :ids
+    """).bindparams(bindparam("ids", expanding=True)), {"ids": ids})
+    c.execute(text("DELETE FROM metrika_queue WHERE id IN :ids").bindparams(bindparam("ids", expanding=True)),
+              {"ids": ids})
+    return len(ids)
+
+def get_table_sizes(c, tables: list[str]) -> dict[str, dict]:
+    """Оценка размера по information_schema (table_rows у InnoDB приблизительный)."""
+    rows = c.execute(text("""
+        SELECT TABLE_NAME AS name, TABLE_ROWS AS table_rows, DATA_LENGTH AS data, INDEX_LENGTH AS idx,
+               DATA_FREE AS free
+        FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN :tables
+    """).bindparams(bindparam("tables", expanding=True)), {"tables": tables}).mappings().all()
+    return {r["name"]: {"rows": int(r["table_rows"] or 0), "data_bytes": int(r["data"] or 0),
+                        "index_bytes": int(r["idx"] or 0), "free_bytes": int(r["free"] or 0)} for r in rows}
+
+def receipt_add(c, key: str, ts: int | None = None) -> bool:
+    """
+    False — такой webhook уже принят (в том числе другим процессом) и его обработка началась
+    не раньше ts+1, т.е. уже видела все изменения секунды ts. Иначе created_at сдвигается на сейчас
+    (отметка нового прогона) и возвращается True.
+    """
+    r = c.execute(text("INSERT IGNORE INTO bitrix_receipt (receipt_key) VALUES (:k)"), {"k": key})
+    if r.rowcount > 0:
+        return True
+    if ts is None:
+        return False
+    r = c.execute(text("""
+        UPDATE bitrix_receipt SET created_at=NOW()
+        WHERE receipt_key=:k AND created_at < FROM_UNIXTIME(:t)
+    """), {"k": key, "t": ts + 1})
+    return r.rowcount > 0
+
+def receipt_forget(c, key: str):
+    c.execute(text("DELETE FROM bitrix_receipt WHERE receipt_key=:k"), {"k": key})
+
+def receipts_cleanup(c, window_sec: int, limit: int = 1000) -> int:
+    r = c.execute(text("""
+        DELETE FROM bitrix_receipt WHERE created_at < NOW() - INTERVAL :w SECOND LIMIT :limit
+    """), {"w": window_sec, "limit": limit})
+    return r.rowcount
+
+def ping(c):
+    c.execute(text("SELECT 1"))
+
+def warm_pool(n: int | None = None) -> int:
+    """Открывает сразу n соединений (по умолчанию — размер пула) и возвращает их в пул."""
+    n = n or engine.pool.size()
+    held = []
+    try:
+        for _ in range(n):
+            c = engine.connect()
+            held.append(c)
+            ping(c)
+    finally:
+        for c in held:
+            c.close()
+    return len(held)
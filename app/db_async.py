@@ -0,0 +1,38 @@
+"""
+Асинхронный доступ к БД (SQLAlchemy asyncio + aiomysql).
+Запросы из app.db переиспользуются как есть: await c.run_sync(get_deal_state, deal_id).
+"""
+import os
+from contextlib import asynccontextmanager
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
+from app.settings import settings
+from app.db import _query_started, _query_finished, _cache_write
+
+
+def _async_url(url: str) -> str:
+    return url.replace("+pymysql", "+aiomysql", 1) if url and "+pymysql" in url else url
+
+
+aengine: AsyncEngine = create_async_engine(
+    os.getenv("ASYNC_DATABASE_URL") or _async_url(settings.database_url),
+    pool_pre_ping=True,
+    pool_size=int(os.getenv("ASYNC_DB_POOL_SIZE", "10")),
+)
+event.listen(aengine.sync_engine, "before_cursor_execute", _query_started)
+event.listen(aengine.sync_engine, "after_cursor_execute", _query_finished)
+
+
+@asynccontextmanager
+async def aconn():
+    # как app.db.conn: записи deal_state попадают в кэш только после коммита
+    pending = []
+    async with aengine.begin() as c:
+        info = c.sync_connection.info
+        info["deal_state_writes"] = pending
+        try:
+            yield c
+        finally:
+            info.pop("deal_state_writes", None)
+    for seq, row in pending:
+        _cache_write(seq, row)
@@ -0,0 +1,119 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from app.logger import get_logger
+
+log = get_logger("app.debounce")
+
+# 0 — выключено (каждый onCrmDealUpdate обрабатывается сразу)
+UPDATE_DEBOUNCE_MS = int(os.getenv("UPDATE_DEBOUNCE_MS", "0"))
+UPDATE_DEBOUNCE_MAX_WAIT_MS = int(os.getenv("UPDATE_DEBOUNCE_MAX_WAIT_MS", "5000"))
+UPDATE_DEBOUNCE_WORKERS = int(os.getenv("UPDATE_DEBOUNCE_WORKERS", "4"))
+# webhook уже получил 200 и Битрикс его не повторит — упавшую обработку повторяем сами: base * 2^(n-1)
+UPDATE_DEBOUNCE_RETRY_MAX = int(os.getenv("UPDATE_DEBOUNCE_RETRY_MAX", "5"))
+UPDATE_DEBOUNCE_RETRY_BASE_MS = int(os.getenv("UPDATE_DEBOUNCE_RETRY_BASE_MS", "2000"))
+
+
+class Coalescer:
+    """
+    Схлопывает серию вызовов с одним ключом (deal_id) в один вызов fn(key).
+    Вызов откладывается на delay после последнего события, но не дольше max_wait от первого.
+    Для одного ключа fn никогда не выполняется параллельно; упавший вызов ставится повторно
+    с экспоненциальной задержкой (не больше retry_max попыток подряд).
+    """
+
+    def __init__(self, fn, delay: float, max_wait: float, workers: int = 4,
+                 retry_max: int = UPDATE_DEBOUNCE_RETRY_MAX, retry_base: float = UPDATE_DEBOUNCE_RETRY_BASE_MS / 1000):
+        self._fn = fn
+        self._delay = delay
+        self._max_wait = max(max_wait, delay)
+        self._pending: dict = {}  # key -> [first_at, due_at]
+        self._running: set = set()
+        self._failures: dict = {}  # key -> сколько раз подряд fn(key) упала
+        self._retry_max = retry_max
+        self._retry_base = retry_base
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="debounce")
+        self._thread = None
+        self.received = 0
+        self.collapsed = 0
+        self.fired = 0
+        self.retried = 0
+        self.failed = 0
+
+    def submit(self, key):
+        now = time.monotonic()
+        with self._cond:
+            self.received += 1
+            ent = self._pending.get(key)
+            if ent:
+                self.collapsed += 1
+                ent[1] = min(now + self._delay, ent[0] + self._max_wait)
+            else:
+                self._pending[key] = [now, now + self._delay]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name="debounce-timer")
+                self._thread.start()
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"received": self.received, "collapsed": self.collapsed, "fired": self.fired,
+                    "pending": len(self._pending), "running": len(self._running),
+                    "retried": self.retried, "failed": self.failed}
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                now = time.monotonic()
+                due = []
+                for key, ent in self._pending.items():
+                    if ent[1] > now:
+                        continue
+                    if key in self._running:
+                        ent[1] = now + self._delay  # ждём, пока закончится предыдущая обработка
+                        continue
+                    due.append(key)
+                for key in due:
+                    del self._pending[key]
+                    self._running.add(key)
+                self.fired += len(due)
+                if not due:
+                    self._cond.wait(max(min(e[1] for e in self._pending.values()) - now, 0.01))
+                    continue
+            for key in due:
+                self._pool.submit(self._call, key)
+
+    def _call(self, key):
+        ok = False
+        try:
+            self._fn(key)
+            ok = True
+        except Exception:
+            log.exception("debounced_call_failed", extra={"key": key})
+        finally:
+            with self._cond:
+                self._running.discard(key)
+                if ok:
+                    self._failures.pop(key, None)
+                else:
+                    self._schedule_retry(key)
+
+    def _schedule_retry(self, key):
+        # вызывается под self._cond
+        n = self._failures.get(key, 0) + 1
+        if n > self._retry_max:
+            self._failures.pop(key, None)
+            self.failed += 1
+            log.error("debounced_call_dropped", extra={"key": key, "attempts": n - 1})
+            return
+        self._failures[key] = n
+        self.retried += 1
+        if key not in self._pending:  # если уже есть новый submit — он и выполнит повтор
+            now = time.monotonic()
+            delay = self._retry_base * 2 ** (n - 1)
+            self._pending[key] = [now, now + delay]
+        self._cond.notify()
@@ -0,0 +1,129 @@
+"""
+Отсечение повторных доставок webhook: Битрикс повторяет событие, если мы отвечаем медленно.
+Ключ — event + ID + ts события + application_token (без ts — хэш всего тела).
+Сначала окно в памяти процесса, затем (WEBHOOK_DEDUP_DB=true) общая таблица bitrix_receipt.
+ts у Битрикса в секундах, поэтому два настоящих onCrmDealUpdate за одну секунду дают один ключ.
+Поэтому для ключа хранится, когда началась его обработка: повтор отбрасывается, только если она
+началась не раньше ts+1 (сделка прочитана уже после всех изменений секунды ts). Иначе повтор
+прогоняется заново — сразу или, если первая доставка ещё обрабатывается, сразу после неё.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+from app.cache import TTLCache
+from app.db import conn, receipt_add, receipt_forget, receipts_cleanup
+from app.metrics import WEBHOOK_DUPLICATES
+from app.logger import get_logger
+
+log = get_logger("app.dedup")
+
+WEBHOOK_DEDUP = os.getenv("WEBHOOK_DEDUP", "true").lower() != "false"
+WEBHOOK_DEDUP_WINDOW_SEC = int(os.getenv("WEBHOOK_DEDUP_WINDOW_SEC", "600"))
+WEBHOOK_DEDUP_SIZE = int(os.getenv("WEBHOOK_DEDUP_SIZE", "50000"))
+WEBHOOK_DEDUP_DB = os.getenv("WEBHOOK_DEDUP_DB", "false").lower() == "true"
+
+_seen = TTLCache("webhook_receipts", WEBHOOK_DEDUP_SIZE, WEBHOOK_DEDUP_WINDOW_SEC)
+_cleanup_lock = threading.Lock()
+_cleanup_at = 0.0
+# _seen: key -> время (time.time()) начала последней обработки
+# ключи, обработка которых идёт сейчас: key -> нужен ли повторный прогон после неё
+_inflight: dict[str, bool] = {}
+_inflight_lock = threading.Lock()
+
+stats = {"memory": 0, "db": 0, "rerun": 0}
+
+
+def receipt_key(event: str, entity_id: int, data: dict) -> str:
+    auth = data.get("auth") if isinstance(data.get("auth"), dict) else {}
+    ts = data.get("ts")
+    if ts:
+        raw = f"{event}:{entity_id}:{ts}:{auth.get('application_token') or ''}"
+    else:
+        raw = json.dumps(data, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def event_ts(data: dict) -> int | None:
+    try:
+        return int(data.get("ts"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _covers(started: float | None, ts: int | None) -> bool:
+    # обработка, начатая не раньше ts+1, уже видела все изменения секунды ts; без ts ключ — всё тело
+    return started is not None and (ts is None or started >= ts + 1)
+
+
+def seen_local(key: str, ts: int | None = None) -> bool:
+    """
+    Атомарно отмечает ключ в окне процесса; True — такой webhook уже был и обрабатывать его не нужно.
+    Новый (или требующий повторного прогона) ключ считается «в обработке» до finish()/forget().
+    """
+    with _inflight_lock:
+        if key in _inflight:
+            if not _covers(_seen.get(key), ts):
+                _inflight[key] = True
+                stats["rerun"] += 1
+            return True
+        now = time.time()
+        if _seen.compute(key, lambda cur: None if _covers(cur, ts) else now) is None:
+            stats["memory"] += 1
+            WEBHOOK_DUPLICATES.labels("memory").inc()
+            return True
+        _inflight[key] = False
+        return False
+
+
+def finish(key: str) -> bool:
+    """Обработка завершена; True — за это время пришёл дубль, надо прогнать событие ещё раз."""
+    with _inflight_lock:
+        if _inflight.get(key):
+            _inflight[key] = False
+            _seen.set(key, time.time())
+            return True
+        _inflight.pop(key, None)
+        return False
+
+
+def seen_db(key: str, ts: int | None = None) -> bool:
+    """Общая для процессов проверка (блокирующая — вызывать через asyncio.to_thread)."""
+    with conn() as c:
+        added = receipt_add(c, key, ts)
+    _maybe_cleanup()
+    if not added:
+        stats["db"] += 1
+        WEBHOOK_DUPLICATES.labels("db").inc()
+    return not added
+
+
+def forget(key: str):
+    """Обработка не удалась — повторная доставка этого события должна пройти."""
+    with _inflight_lock:
+        _inflight.pop(key, None)
+        _seen.pop(key)
+    if WEBHOOK_DEDUP_DB:
+        try:
+            with conn() as c:
+                receipt_forget(c, key)
+        except Exception as e:
+            log.warning("receipt_forget_failed", extra={"error": str(e)})
+
+
+def _maybe_cleanup():
+    global _cleanup_at
+    now = time.monotonic()
+    if now - _cleanup_at < 60 or not _cleanup_lock.acquire(blocking=False):
+        return
+    try:
+        _cleanup_at = now
+        with conn() as c:
+            n = receipts_cleanup(c, WEBHOOK_DEDUP_WINDOW_SEC)
+        if n:
+            log.info("receipts_cleanup", extra={"deleted": n})
+    except Exception as e:
+        log.warning("receipts_cleanup_failed", extra={"error": str(e)})
+    finally:
+        _cleanup_lock.release()
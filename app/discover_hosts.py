@@ -0,0 +1,135 @@
+"""
+Сканирует все сделки и собирает частоты хостов из поля маршрутизации:
+    python -m app.discover_hosts [--field UF_CRM_...] [--workers 4] [--reset] [--write-db]
+Сделки делятся на диапазоны ID, которые читаются параллельно (общий лимит запросов — bx_limiter).
+Прогресс сохраняется в чекпоинт-файл, повторный запуск продолжает с места остановки.
+"""
+import os
+import json
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from app.settings import settings
+from app import bitrix as bx
+from app.logger import configure_root, get_logger
+
+configure_root("discover.log")
+log = get_logger("app.discover_hosts")
+
+CHECKPOINT_FILE = os.getenv("DISCOVER_CHECKPOINT", "discover_checkpoint.json")
+
+
+class Scan:
+    def __init__(self, field: str, path: str):
+        self.field = field
+        self.path = path
+        self.counts = Counter()
+        self.partitions: list[dict] = []
+        self.seen = 0
+        self._lock = threading.Lock()
+
+    def load(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("field") != self.field:
+            return False
+        self.counts = Counter(data.get("counts") or {})
+        self.partitions = data.get("partitions") or []
+        self.seen = int(data.get("seen") or 0)
+        return True
+
+    def save(self):
+        with self._lock:
+            data = {"field": self.field, "seen": self.seen, "partitions": self.partitions, "counts": self.counts}
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+
+    def add_page(self, part: dict, page: list[dict]):
+        hosts = Counter()
+        for it in page:
+            host = bx.routing_value_from_deal(it, self.field)
+            if host:
+                hosts[host] += 1
+        with self._lock:
+            self.counts.update(hosts)
+            self.seen += len(page)
+            part["last_id"] = int(page[-1]["ID"])
+
+
+def _max_deal_id() -> int:
+    res = bx.bx_call("crm.deal.list", select=["ID"], order={"ID": "DESC"}, start=-1)
+    return int(res[0]["ID"]) if res else 0
+
+
+def _partitions(max_id: int, n: int) -> list[dict]:
+    step = max(max_id // n + 1, 1)
+    return [{"lo": lo, "hi": min(lo + step, max_id), "last_id": lo, "done": False}
+            for lo in range(0, max_id, step)]
+
+
+def _scan_partition(scan: Scan, part: dict):
+    for page in bx.iter_list("crm.deal.list", filter={"<=ID": part["hi"]}, select=["ID", scan.field],
+                             after_id=part["last_id"]):
+        scan.add_page(part, page)
+        scan.save()
+    part["done"] = True
+    scan.save()
+
+
+def run(field: str, workers: int, reset: bool = False) -> Scan:
+    scan = Scan(field, CHECKPOINT_FILE)
+    if reset or not scan.load():
+        scan = Scan(field, CHECKPOINT_FILE)
+        scan.partitions = _partitions(_max_deal_id(), workers)
+    todo = [p for p in scan.partitions if not p["done"]]
+    log.info("discover_started", extra={"field": field, "partitions": len(todo), "seen": scan.seen})
+    with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="discover") as pool:
+        for f in [pool.submit(_scan_partition, scan, p) for p in todo]:
+            f.result()
+    return scan
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Discover routing hosts used in deals")
+    ap.add_argument("--field", default=settings.uf_routing_field)
+    ap.add_argument("--workers", type=int, default=int(os.getenv("DISCOVER_WORKERS", "4")))
+    ap.add_argument("--reset", action="store_true", help="начать заново, игнорируя чекпоинт")
+    ap.add_argument("--write-db", action="store_true", help="добавить новые хосты в metrika_routing (is_active=0)")
+    args = ap.parse_args()
+
+    scan = run(args.field, args.workers, reset=args.reset)
+    counts = scan.counts
+
+    print(f"\nОбработано строк: {scan.seen}")
+    print(f"Уникальных хостов: {len(counts)}\n")
+    print("ТОП-50 хостов по частоте:")
+    for host, n in counts.most_common(50):
+        print(f"{host}\t{n}")
+
+    # Скелет для METRIKA_ROUTING_JSON
+    skeleton = [
+        {"uf_value": f"https://{host}", "counter_id": 0, "mp_token": ""}
+        for host in sorted(counts.keys())
+    ]
+    with open("uf_hosts_counts.json", "w", encoding="utf-8") as f:
+        json.dump(counts, f, ensure_ascii=False, indent=2)
+    with open("metrika_routing_skeleton.json", "w", encoding="utf-8") as f:
+        json.dump(skeleton, f, ensure_ascii=False, indent=2)
+    print("\nФайлы сохранены:")
+    print(" - uf_hosts_counts.json (частоты)")
+    print(" - metrika_routing_skeleton.json (шаблон для .env)")
+
+    if args.write_db:
+        from app.db import conn, add_routing_candidates
+        with conn() as c:
+            added = add_routing_candidates(c, sorted(counts.keys()))
+        print(f" - metrika_routing: добавлено неактивных строк: {added}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import os
+import time
+import random
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+from app.db import (conn, inbound_add, claim_inbound_batch, mark_inbound_done, mark_inbound_error,
+                    release_inbound, purge_inbound_done)
+from app.logic import dispatch_event
+from app.logger import get_logger
+
+log = get_logger("app.ingest")
+
+# inline — обрабатываем webhook прямо в запросе (как раньше); queue — пишем в bitrix_inbound и отвечаем сразу
+INGEST_MODE = os.getenv("INGEST_MODE", "inline").lower()
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "4"))
+INGEST_BATCH = int(os.getenv("INGEST_BATCH", "50"))
+# Битрикс уже получил 200 и не пришлёт событие повторно — повторяем с растущей паузой,
+# чтобы пережить недоступность портала (5+10+...+320 с ≈ 10 минут при настройках по умолчанию)
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "8"))
+INGEST_RETRY_BASE_SEC = float(os.getenv("INGEST_RETRY_BASE_SEC", "5"))
+INGEST_RETRY_CAP_SEC = float(os.getenv("INGEST_RETRY_CAP_SEC", "900"))
+INGEST_STALE_SEC = int(os.getenv("INGEST_STALE_SEC", "300"))
+# обработанные строки bitrix_inbound храним столько секунд, чистим раз в INGEST_PURGE_EVERY_SEC
+INGEST_DONE_RETENTION_SEC = int(os.getenv("INGEST_DONE_RETENTION_SEC", "86400"))
+INGEST_PURGE_EVERY_SEC = int(os.getenv("INGEST_PURGE_EVERY_SEC", "300"))
+
+stats = {"collapsed": 0}
+
+
+def accept(event: str, deal_id: int):
+    """Только сохраняет событие — вся работа с Битриксом/БД делается в ingest_loop."""
+    with conn() as c:
+        inbound_add(c, event, deal_id)
+
+
+def _retry_delay(attempts: int) -> float | None:
+    """attempts — сколько попыток уже сделано вместе с текущей."""
+    if attempts >= INGEST_MAX_ATTEMPTS:
+        return None
+    delay = min(INGEST_RETRY_BASE_SEC * 2 ** (attempts - 1), INGEST_RETRY_CAP_SEC)
+    return max(1.0, delay * random.uniform(0.5, 1.0))
+
+
+def _process_deal(items: list):
+    # события одной сделки — строго по порядку поступления;
+    # подряд идущие onCrmDealUpdate схлопываем в одну обработку (последнюю)
+    for i, item in enumerate(items):
+        nxt = items[i + 1] if i + 1 < len(items) else None
+        if item["event"] == "onCrmDealUpdate" and nxt and nxt["event"] == "onCrmDealUpdate":
+            with conn() as c:
+                mark_inbound_done(c, item["id"])
+            stats["collapsed"] += 1
+            continue
+        try:
+            dispatch_event(item["event"], item["deal_id"])
+            with conn() as c:
+                mark_inbound_done(c, item["id"])
+        except Exception as e:
+            # дальше по сделке не идём: Update не должен обгонять упавший Add; остаток вернётся в очередь
+            # за упавшим событием (оно сохраняет свой id и остаётся головой сделки)
+            rest = [it["id"] for it in items[i + 1:]]
+            attempts = int(item.get("attempts") or 0) + 1
+            retry_in = _retry_delay(attempts)
+            with conn() as c:
+                mark_inbound_error(c, item["id"], str(e), retry_in)
+                release_inbound(c, rest)
+            log.error("inbound_failed", extra={"inbound_id": item["id"], "deal_id": item["deal_id"],
+                                               "event": item["event"], "error": str(e), "deferred": len(rest),
+                                               "attempts": attempts,
+                                               "retry_in": int(retry_in) if retry_in is not None else None})
+            return
+
+
+def ingest_loop():
+    log.info("ingest_started", extra={"concurrency": INGEST_CONCURRENCY})
+    pool = ThreadPoolExecutor(max_workers=INGEST_CONCURRENCY, thread_name_prefix="ingest")
+    purged_at = 0.0
+    while True:
+        try:
+            if time.monotonic() - purged_at > INGEST_PURGE_EVERY_SEC:
+                purged_at = time.monotonic()
+                with conn() as c:
+                    n = purge_inbound_done(c, INGEST_DONE_RETENTION_SEC)
+                if n:
+                    log.info("inbound_purged", extra={"deleted": n})
+            with conn() as c:
+                batch = claim_inbound_batch(c, limit=INGEST_BATCH, stale_sec=INGEST_STALE_SEC)
+            if not batch:
+                time.sleep(0.5)
+                continue
+            by_deal = defaultdict(list)
+            for item in batch:
+                by_deal[item["deal_id"]].append(item)
+            wait([pool.submit(_process_deal, items) for items in by_deal.values()])
+            log.info("inbound_batch_done", extra={"events": len(batch), "deals": len(by_deal)})
+        except Exception:
+            log.exception("ingest_loop_error")
+            time.sleep(2)
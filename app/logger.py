@@ -1,10 +1,14 @@
-import os, logging, sys
-from logging.handlers import RotatingFileHandler
+import os, logging, sys, queue, atexit
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from pythonjsonlogger import jsonlogger
 
 LOG_DIR = os.getenv("LOG_DIR", "/var/log/metrika-bx")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 LOG_JSON = (os.getenv("LOG_JSON", "true").lower() == "true")
+# LOG_QUEUE=true: вызывающий поток только кладёт запись в очередь; JSON-форматирование и запись
+# в файл/stdout — в фоновом потоке. При переполнении очереди записи отбрасываются, а не блокируют.
+LOG_QUEUE = (os.getenv("LOG_QUEUE", "true").lower() == "true")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
 
 os.makedirs(LOG_DIR, exist_ok=True)
 
@@ -37,14 +41,58 @@ def _make_handlers(filename: str):
 
     return [file_handler, console]
 
+class _DroppingQueueHandler(QueueHandler):
+    dropped = 0
+
+    def prepare(self, record):
+        # только подставляем args (они могут измениться после возврата); форматирование — в listener
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DroppingQueueHandler.dropped += 1
+
+
+_listener: QueueListener | None = None
+_queue: queue.Queue | None = None
+
+
 def configure_root(app_logfile: str = "app.log"):
     logging.captureWarnings(True)
     root = logging.getLogger()
     if root.handlers:
         return
     root.setLevel(LOG_LEVEL)
-    for h in _make_handlers(app_logfile):
-        root.addHandler(h)
+    handlers = _make_handlers(app_logfile)
+    if not LOG_QUEUE:
+        for h in handlers:
+            root.addHandler(h)
+        return
+    root.addHandler(_DroppingQueueHandler(None))
+    _start_listener(handlers)
+    atexit.register(lambda: _listener and _listener.stop())  # дописать хвост очереди при штатном завершении
+    # python -m app.worker N форкает процессы: поток listener в дочерний не переходит — поднимаем свой
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=lambda: _start_listener(_listener.handlers))
+
+
+def _start_listener(handlers):
+    global _listener, _queue
+    _queue = queue.Queue(LOG_QUEUE_SIZE)
+    for h in logging.getLogger().handlers:
+        if isinstance(h, _DroppingQueueHandler):
+            h.queue = _queue
+    _listener = QueueListener(_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def log_stats() -> dict:
+    return {"queued": _queue.qsize() if _queue else 0, "dropped": _DroppingQueueHandler.dropped,
+            "async": _listener is not None}
 
 def get_logger(name: str):
     return logging.getLogger(name)
@@ -1,14 +1,21 @@
 from app.settings import settings
 from app import bitrix as bx
 from app.router import router
-from app.db import conn, get_deal_state, upsert_deal_state, enqueue
+from app.db import conn, get_deal_state, lock_deal_state, cached_deal_state, upsert_deal_state, enqueue
 from app.metrika import build_payload, payload_hash
 from app.logger import get_logger
 from app.utils import normalize_phone, sha256_hex
+from app.cache import TTLCache
 from dateutil import parser as dtparser
 
 log = get_logger("app.logic")
 
+# contact_id -> (phone, email, ep с phash/ehash); размер и TTL — общие с bx.contact_ids
+contact_identity = TTLCache("contact_identity", bx.CONTACT_CACHE_SIZE, bx.CONTACT_CACHE_TTL)
+
+# сколько onCrmDealUpdate отброшено до работы с контактом/БД
+fast_path_stats = {"updates": 0, "skipped_stage": 0, "skipped_same_stage": 0}
+
 
 def _extract_client_id(deal: dict) -> str:
     """
@@ -48,10 +55,13 @@ def stage_to_event(stage_id: str) -> str | None:
     return None
 
 
-def _contact_ep(contact_id: int | None) -> dict:
+def _contact_ep(contact_id: int | None, contact: dict | None = None) -> dict:
     if not contact_id:
         return {}
-    c = bx.get_contact_light(contact_id)
+    cached = contact_identity.get(contact_id)
+    if cached and (contact is None or (contact.get("PHONE"), contact.get("EMAIL")) == cached[:2]):
+        return dict(cached[2])
+    c = contact or bx.get_contact_light(contact_id)
     ep = {"contact_id": c.get("ID")}
     phone_norm = normalize_phone(c.get("PHONE") or "")
     email_norm = (c.get("EMAIL") or "").strip().lower()
@@ -59,77 +69,137 @@ def _contact_ep(contact_id: int | None) -> dict:
         ep["phash"] = sha256_hex(phone_norm)
     if email_norm:
         ep["ehash"] = sha256_hex(email_norm)
+    contact_identity.set(contact_id, (c.get("PHONE"), c.get("EMAIL"), dict(ep)))
     return ep
 
 
+def invalidate_contact(contact_id: int):
+    contact_identity.pop(contact_id)
+    n = bx.contact_ids.pop_values(contact_id)
+    log.info("contact_cache_invalidated", extra={"contact_id": contact_id, "lookup_keys": n})
+
+
+def _enqueue_created(c, deal_id: int, deal: dict, event_type: str, client_id: str, extra_ep: dict):
+    state = lock_deal_state(c, deal_id)
+    try:
+        counter_id, token, used_uf = resolve_counter(deal, state)
+    except RuntimeError as e:
+        log.warning("resolve_counter_failed", extra={"deal_id": deal_id, "error": str(e)})
+        return
+    payload = build_payload(counter_id, token, client_id, event_type, deal, used_uf, extra_ep=extra_ep)
+    h = payload_hash(payload)
+    if state and state.get("last_sent_hash") == h:
+        log.info("dup_payload_skip", extra={"deal_id": deal_id, "event": event_type})
+        return
+    # то же событие мог уже поставить параллельный webhook (или оно ещё не отправлено) — строку не дублируем,
+    # но deal_state обновляем в любом случае, иначе быстрый путь по стадии не сработает
+    queued = enqueue(c, deal_id, event_type, payload, h)
+    upsert_deal_state(
+        c,
+        deal_id=deal_id,
+        # last_stage_id — стадия, по которой уже поставлено событие оплаты/отмены (см. _update_is_relevant);
+        # deal_created её не занимает, иначе сделка, созданная сразу в оплате, не дала бы deal_paid
+        last_stage_id=state.get("last_stage_id") if state else None,
+        last_sent_hash=h,
+        locked_counter_id=state.get("locked_counter_id") if state else None,
+        locked_mp_token=state.get("locked_mp_token") if state else None,
+        locked_uf_value=state.get("locked_uf_value") if state else None,
+    )
+    if queued:
+        log.info("queued_event", extra={"deal_id": deal_id, "event": event_type})
+    else:
+        log.info("dup_payload_skip", extra={"deal_id": deal_id, "event": event_type, "pending": True})
+
+
+def _enqueue_stage_event(c, deal_id: int, deal: dict, ev: str, stg: str, client_id: str, extra_ep: dict):
+    state = lock_deal_state(c, deal_id)
+    try:
+        counter_id, token, used_uf = resolve_counter(deal, state)
+    except RuntimeError as e:
+        log.warning("resolve_counter_failed", extra={"deal_id": deal_id, "error": str(e)})
+        return
+    payload = build_payload(counter_id, token, client_id, ev, deal, used_uf, extra_ep=extra_ep)
+    h = payload_hash(payload)
+    if state and state.get("last_sent_hash") == h:
+        log.info("dup_payload_skip", extra={"deal_id": deal_id, "event": ev})
+        return
+    # то же событие мог уже поставить параллельный webhook (или оно ещё не отправлено) — строку не дублируем,
+    # но deal_state обновляем в любом случае, иначе быстрый путь по стадии не сработает
+    queued = enqueue(c, deal_id, ev, payload, h)
+    upsert_deal_state(
+        c,
+        deal_id=deal_id,
+        last_stage_id=stg,
+        last_sent_hash=h,
+        locked_counter_id=(state.get("locked_counter_id") if state and state.get("locked_counter_id") else counter_id),
+        locked_mp_token=(state.get("locked_mp_token") if state and state.get("locked_mp_token") else token),
+        locked_uf_value=(state.get("locked_uf_value") if state and state.get("locked_uf_value") else used_uf),
+    )
+    if queued:
+        log.info("queued_event", extra={"deal_id": deal_id, "event": ev})
+    else:
+        log.info("dup_payload_skip", extra={"deal_id": deal_id, "event": ev, "pending": True})
+
+
+def _stage_already_queued(state: dict | None, stg: str) -> bool:
+    return bool(state and state.get("last_stage_id") == stg and state.get("last_sent_hash"))
+
+
 def process_deal_event(event_type: str, deal_id: int):
-    deal = bx.get_deal_full(deal_id)
+    deal, contact = bx.get_deal_with_contact(deal_id)
 
-    contact_id = bx.ensure_contact_for_deal(deal)
+    contact_id, contact = bx.resolve_contact(deal, contact)
     if not has_required(deal):
         return
 
     client_id = _extract_client_id(deal)
+    extra_ep = _contact_ep(contact_id, contact)
 
     with conn() as c:
-        state = get_deal_state(c, deal_id)
-        try:
-            counter_id, token, used_uf = resolve_counter(deal, state)
-        except RuntimeError as e:
-            log.warning("resolve_counter_failed", extra={"deal_id": deal_id, "error": str(e)})
-            return
-        extra_ep = _contact_ep(contact_id)
-        payload = build_payload(counter_id, token, client_id, event_type, deal, used_uf, extra_ep=extra_ep)
-        h = payload_hash(payload)
-        if state and state.get("last_sent_hash") == h:
-            log.info("dup_payload_skip", extra={"deal_id": deal_id, "event": event_type})
-            return
-        enqueue(c, deal_id, event_type, payload)
-        upsert_deal_state(
-            c,
-            deal_id=deal_id,
-            last_stage_id=deal.get("STAGE_ID"),
-            last_sent_hash=h,
-            locked_counter_id=state.get("locked_counter_id") if state else None,
-            locked_mp_token=state.get("locked_mp_token") if state else None,
-            locked_uf_value=state.get("locked_uf_value") if state else None,
-        )
-        log.info("queued_event", extra={"deal_id": deal_id, "event": event_type})
+        _enqueue_created(c, deal_id, deal, event_type, client_id, extra_ep)
+
+
+def _update_is_relevant(deal_id: int, stg: str, ev: str | None) -> bool:
+    """
+    Быстрая проверка по стадии: событие отправляем только для стадий из paid/cancelled
+    и только если эту стадию сделки мы ещё не ставили в очередь.
+    """
+    fast_path_stats["updates"] += 1
+    if not ev:
+        fast_path_stats["skipped_stage"] += 1
+        return False
+    state = cached_deal_state(deal_id)
+    if state is None:
+        with conn() as c:
+            state = get_deal_state(c, deal_id)
+    if _stage_already_queued(state, stg):
+        fast_path_stats["skipped_same_stage"] += 1
+        log.info("same_stage_skip", extra={"deal_id": deal_id, "stage": stg})
+        return False
+    return True
 
 
 def handle_update(deal_id: int):
-    deal = bx.get_deal_full(deal_id)
+    deal, contact = bx.get_deal_with_contact(deal_id)
+
+    stg = bx.get_deal_stage_id(deal)
+    ev = stage_to_event(stg)
+    if not _update_is_relevant(deal_id, stg, ev):
+        return
 
-    contact_id = bx.ensure_contact_for_deal(deal)
+    contact_id, contact = bx.resolve_contact(deal, contact)
     if not has_required(deal):
         return
 
     client_id = _extract_client_id(deal)
+    extra_ep = _contact_ep(contact_id, contact)
 
-    stg = bx.get_deal_stage_id(deal)
-    ev = stage_to_event(stg)
-    if ev:
-        with conn() as c:
-            state = get_deal_state(c, deal_id)
-            try:
-                counter_id, token, used_uf = resolve_counter(deal, state)
-            except RuntimeError as e:
-                log.warning("resolve_counter_failed", extra={"deal_id": deal_id, "error": str(e)})
-                return
-            extra_ep = _contact_ep(contact_id)
-            payload = build_payload(counter_id, token, client_id, ev, deal, used_uf, extra_ep=extra_ep)
-            h = payload_hash(payload)
-            if state and state.get("last_sent_hash") == h:
-                log.info("dup_payload_skip", extra={"deal_id": deal_id, "event": ev})
-                return
-            enqueue(c, deal_id, ev, payload)
-            upsert_deal_state(
-                c,
-                deal_id=deal_id,
-                last_stage_id=stg,
-                last_sent_hash=h,
-                locked_counter_id=(state.get("locked_counter_id") if state and state.get("locked_counter_id") else counter_id),
-                locked_mp_token=(state.get("locked_mp_token") if state and state.get("locked_mp_token") else token),
-                locked_uf_value=(state.get("locked_uf_value") if state and state.get("locked_uf_value") else used_uf),
-            )
-            log.info("queued_event", extra={"deal_id": deal_id, "event": ev})
+    with conn() as c:
+        _enqueue_stage_event(c, deal_id, deal, ev, stg, client_id, extra_ep)
+
+
+def dispatch_event(event: str, deal_id: int):
+    if event == "onCrmDealAdd":
+        process_deal_event("deal_created", deal_id)
+    elif event == "onCrmDealUpdate":
+        handle_update(deal_id)
@@ -0,0 +1,80 @@
+"""
+Асинхронный путь обработки webhook (ASYNC_IO=true): Bitrix/БД без пула потоков.
+Правила те же, что в app.logic — переиспользуются его функции; SQL выполняется через AsyncConnection.run_sync.
+"""
+import asyncio
+from app import bitrix_async as abx
+from app.bitrix import get_deal_stage_id
+from app.db import get_deal_state, cached_deal_state
+from app.db_async import aconn
+from app.router import router
+from app.logger import get_logger
+from app.logic import (fast_path_stats, contact_identity, has_required, stage_to_event, _extract_client_id,
+                       _contact_ep, _enqueue_created, _enqueue_stage_event, _stage_already_queued)
+
+log = get_logger("app.logic_async")
+
+
+async def _acontact_ep(contact_id: int | None, contact: dict | None) -> dict:
+    # _contact_ep сам идёт в Битрикс только без контакта и без кэша — здесь этот запрос делаем асинхронно
+    if contact_id and contact is None and contact_identity.get(contact_id) is None:
+        contact = await abx.aget_contact_light(contact_id)
+    return _contact_ep(contact_id, contact)
+
+
+async def _aprepare_routing(deal: dict):
+    # has_required/resolve_counter синхронные: всё, что они могли бы загрузить по сети/из БД, грузим заранее
+    await abx.aensure_enums(deal)
+    if router.age() == float("inf"):
+        await asyncio.to_thread(router.ensure_loaded)
+
+
+async def aprocess_deal_event(event_type: str, deal_id: int):
+    deal, contact = await abx.aget_deal_with_contact(deal_id)
+
+    contact_id, contact = await abx.aresolve_contact(deal, contact)
+    await _aprepare_routing(deal)
+    if not has_required(deal):
+        return
+
+    client_id = _extract_client_id(deal)
+    extra_ep = await _acontact_ep(contact_id, contact)
+
+    async with aconn() as c:
+        await c.run_sync(_enqueue_created, deal_id, deal, event_type, client_id, extra_ep)
+
+
+async def _aupdate_is_relevant(deal_id: int, stg: str, ev: str | None) -> bool:
+    fast_path_stats["updates"] += 1
+    if not ev:
+        fast_path_stats["skipped_stage"] += 1
+        return False
+    state = cached_deal_state(deal_id)
+    if state is None:
+        async with aconn() as c:
+            state = await c.run_sync(get_deal_state, deal_id)
+    if _stage_already_queued(state, stg):
+        fast_path_stats["skipped_same_stage"] += 1
+        log.info("same_stage_skip", extra={"deal_id": deal_id, "stage": stg})
+        return False
+    return True
+
+
+async def ahandle_update(deal_id: int):
+    deal, contact = await abx.aget_deal_with_contact(deal_id)
+
+    stg = get_deal_stage_id(deal)
+    ev = stage_to_event(stg)
+    if not await _aupdate_is_relevant(deal_id, stg, ev):
+        return
+
+    contact_id, contact = await abx.aresolve_contact(deal, contact)
+    await _aprepare_routing(deal)
+    if not has_required(deal):
+        return
+
+    client_id = _extract_client_id(deal)
+    extra_ep = await _acontact_ep(contact_id, contact)
+
+    async with aconn() as c:
+        await c.run_sync(_enqueue_stage_event, deal_id, deal, ev, stg, client_id, extra_ep)
@@ -1,25 +1,67 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
 from threading import Thread
 import json
 import asyncio
-import time, os
+import time, os, random
 
 from app.worker import worker_loop
-from app.logic import process_deal_event, handle_update
+from app.ingest import INGEST_MODE, accept, ingest_loop, stats as ingest_stats
+from app.debounce import Coalescer, UPDATE_DEBOUNCE_MS, UPDATE_DEBOUNCE_MAX_WAIT_MS, UPDATE_DEBOUNCE_WORKERS
+from app.logic import process_deal_event, handle_update, invalidate_contact, fast_path_stats
 from app.settings import settings
-from app.logger import configure_root, get_logger
+from app import bitrix as bx
+from app.logger import configure_root, get_logger, log_stats
+from app.sessions import pool_stats
+from app.cache import cache_stats
+from app import dedup, warmup
+from app.metrics import WEBHOOK_SECONDS, render as render_metrics
 
 configure_root("app.log")
 log = get_logger("app.main")
 
 app = FastAPI(title="Bitrix→Metrika MP")
 
-t = Thread(target=worker_loop, daemon=True, name="metrika-worker")
-t.start()
+RUN_WORKER = os.getenv("RUN_WORKER", "true").lower() != "false"
+
+
+def _startup():
+    # прогрев (пул БД, маршруты, enum, HTTP) до запуска фоновых потоков; пока он идёт, /ready отвечает 503
+    warmup.run()
+    # при запуске отдельного воркера (python -m app.worker N) выставьте RUN_WORKER=false
+    if RUN_WORKER:
+        Thread(target=worker_loop, daemon=True, name="metrika-worker").start()
+    if INGEST_MODE == "queue":
+        Thread(target=ingest_loop, daemon=True, name="bitrix-ingest").start()
+
+
+@app.on_event("startup")
+async def _start_background():
+    # в фоне: /health (liveness) отвечает сразу, готовность — через /ready
+    Thread(target=_startup, daemon=True, name="startup").start()
+
+# ASYNC_IO=true: Bitrix/Metrika/БД в webhook через httpx/aiomysql прямо в event loop, без asyncio.to_thread
+ASYNC_IO = os.getenv("ASYNC_IO", "false").lower() == "true"
+if ASYNC_IO:
+    from app.logic_async import aprocess_deal_event, ahandle_update
+    from app.sessions import close_async_clients
+
+    @app.on_event("shutdown")
+    async def _close_async_clients():
+        await close_async_clients()
+
+update_coalescer = Coalescer(
+    handle_update, UPDATE_DEBOUNCE_MS / 1000, UPDATE_DEBOUNCE_MAX_WAIT_MS / 1000, UPDATE_DEBOUNCE_WORKERS
+) if UPDATE_DEBOUNCE_MS > 0 else None
 
 LOG_BODY = os.getenv("LOG_REQUEST_BODY", "true").lower() != "false"
 MAX_BODY = int(os.getenv("LOG_REQUEST_BODY_MAX", "2048"))
+# доля запросов, чьё тело попадает в лог (0..1), и предел размера, до которого тело вообще разбираем
+# для маскирования; тела крупнее логируются только размером
+BODY_SAMPLE = float(os.getenv("LOG_REQUEST_BODY_SAMPLE", "1"))
+BODY_PARSE_MAX = int(os.getenv("LOG_REQUEST_BODY_PARSE_MAX", "16384"))
 SENSITIVE_FIELDS = {"password", "token", "secret", "authorization"}
+KNOWN_EVENTS = {"onCrmDealAdd", "onCrmDealUpdate", "onCrmContactUpdate", "onCrmContactDelete"}
 
 
 def _mask_sensitive(body: str) -> str:
@@ -44,10 +86,13 @@ def _mask_sensitive(body: str) -> str:
 async def log_requests(request: Request, call_next):
     start = time.time()
     body_preview = None
-    if LOG_BODY:
+    log_body = LOG_BODY and (BODY_SAMPLE >= 1 or random.random() < BODY_SAMPLE)
+    if log_body:
         try:
             body_bytes = await request.body()
-            if body_bytes:
+            if len(body_bytes) > BODY_PARSE_MAX:
+                body_preview = f"<{len(body_bytes)} bytes>"
+            elif body_bytes:
                 body_preview = _mask_sensitive(body_bytes.decode("utf-8", "ignore"))[:MAX_BODY]
             else:
                 body_preview = ""
@@ -58,7 +103,11 @@ async def log_requests(request: Request, call_next):
         resp = await call_next(request)
         return resp
     finally:
-        duration_ms = int((time.time() - start) * 1000)
+        elapsed = time.time() - start
+        duration_ms = int(elapsed * 1000)
+        if request.url.path == "/bitrix/events":
+            ev = getattr(request.state, "event", None)
+            WEBHOOK_SECONDS.labels(ev if ev in KNOWN_EVENTS else "other").observe(elapsed)
         extra = {
             "path": request.url.path,
             "query": str(request.url.query),
@@ -66,7 +115,7 @@ async def log_requests(request: Request, call_next):
             "status": getattr(resp, "status_code", 0),
             "duration_ms": duration_ms,
         }
-        if LOG_BODY and body_preview is not None:
+        if body_preview is not None:
             extra["body"] = body_preview
         log.info("http_request", extra=extra)
 
@@ -81,6 +130,7 @@ async def bitrix_events(request: Request):
 
     data = await request.json()
     event = data.get("event")
+    request.state.event = event
     fields = (data.get("data") or {}).get("FIELDS") or {}
     deal_id = int(fields.get("ID") or fields.get("dealId") or 0)
 
@@ -90,15 +140,75 @@ async def bitrix_events(request: Request):
 
     log.info("event_received", extra={"event": event, "deal_id": deal_id})
 
+    if event in ("onCrmContactUpdate", "onCrmContactDelete"):
+        # для событий контакта в FIELDS.ID приходит ID контакта; работа только с in-memory кэшем
+        invalidate_contact(deal_id)
+        return {"ok": True, "event": event, "contact_id": deal_id}
+
+    receipt = None
+    try:
+        if dedup.WEBHOOK_DEDUP:
+            receipt = dedup.receipt_key(event, deal_id, data)
+            ts = dedup.event_ts(data)
+            if dedup.seen_local(receipt, ts):
+                receipt = None  # ключ принадлежит первой доставке (или уже обработан) — не трогаем
+                log.info("duplicate_webhook", extra={"event": event, "deal_id": deal_id})
+                return {"ok": True, "event": event, "deal_id": deal_id, "duplicate": True}
+            if dedup.WEBHOOK_DEDUP_DB and await asyncio.to_thread(dedup.seen_db, receipt, ts):
+                dedup.finish(receipt)
+                receipt = None
+                log.info("duplicate_webhook", extra={"event": event, "deal_id": deal_id, "source": "db"})
+                return {"ok": True, "event": event, "deal_id": deal_id, "duplicate": True}
+
+        resp = await _handle_deal_event(event, deal_id)
+        while receipt and dedup.finish(receipt):
+            # дубль пришёл во время обработки: он мог быть другим изменением в ту же секунду — читаем сделку заново
+            log.info("webhook_rerun", extra={"event": event, "deal_id": deal_id})
+            resp = await _handle_deal_event(event, deal_id)
+        return resp
+    except Exception:
+        if receipt:
+            await asyncio.to_thread(dedup.forget, receipt)
+        raise
+
+
+async def _handle_deal_event(event: str, deal_id: int) -> dict:
+    if INGEST_MODE == "queue":
+        await asyncio.to_thread(accept, event, deal_id)
+        return {"ok": True, "event": event, "deal_id": deal_id, "queued": True}
+
     if event == "onCrmDealAdd":
         log.info("before_handle_create", extra={"deal_id": deal_id})
-        await asyncio.to_thread(process_deal_event, "deal_created", deal_id)
+        if ASYNC_IO:
+            await aprocess_deal_event("deal_created", deal_id)
+        else:
+            await asyncio.to_thread(process_deal_event, "deal_created", deal_id)
+    elif event == "onCrmDealUpdate" and update_coalescer:
+        update_coalescer.submit(deal_id)
+        return {"ok": True, "event": event, "deal_id": deal_id, "debounced": True}
     elif event == "onCrmDealUpdate":
         log.info("before_handle_update", extra={"deal_id": deal_id})
-        await asyncio.to_thread(handle_update, deal_id)
+        if ASYNC_IO:
+            await ahandle_update(deal_id)
+        else:
+            await asyncio.to_thread(handle_update, deal_id)
 
     return {"ok": True, "event": event, "deal_id": deal_id}
 
 @app.get("/health")
 def health():
-    return {"ok": True, "paid": settings.paid_stages, "cancel": settings.cancelled_stages}
+    return {"ok": True, "paid": settings.paid_stages, "cancel": settings.cancelled_stages, "http": pool_stats(),
+            "debounce": update_coalescer.stats() if update_coalescer else None,
+            "ingest_collapsed": ingest_stats["collapsed"], "caches": cache_stats(),
+            "update_fast_path": fast_path_stats, "bitrix_rate": bx.bx_limiter.stats(),
+            "logging": log_stats(), "webhook_duplicates": dedup.stats}
+
+@app.get("/ready")
+def ready():
+    ok, body = warmup.readiness()
+    return JSONResponse(body, status_code=200 if ok else 503)
+
+@app.get("/metrics")
+def metrics():
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
@@ -0,0 +1,90 @@
+import os
+import time
+import threading
+from prometheus_client import (Counter, Histogram, REGISTRY, CollectorRegistry, generate_latest, start_http_server,
+                               multiprocess, CONTENT_TYPE_LATEST)
+from prometheus_client.core import GaugeMetricFamily
+from app.logger import get_logger
+
+log = get_logger("app.metrics")
+
+QUEUE_STATS_TTL = float(os.getenv("QUEUE_STATS_TTL", "15"))
+# несколько процессов (uvicorn --workers N, python -m app.worker N): каждый пишет метрики в файлы этого
+# каталога, /metrics отдаёт сумму. Задаётся в окружении до старта процессов, каталог чистится при деплое.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+BX_CALL_SECONDS = Histogram("bx_call_seconds", "Bitrix REST call latency", ["method"])
+METRIKA_SEND_SECONDS = Histogram("metrika_send_seconds", "Metrika collect request latency", ["counter"])
+WEBHOOK_SECONDS = Histogram("webhook_seconds", "/bitrix/events handling time", ["event"])
+BX_RATE_WAIT_SECONDS = Histogram("bx_rate_limit_wait_seconds", "Time spent waiting for a Bitrix rate limit token",
+                                 buckets=(0, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+BX_THROTTLED = Counter("bx_throttled_total", "QUERY_LIMIT_EXCEEDED responses from Bitrix")
+WEBHOOK_DUPLICATES = Counter("webhook_duplicates_total", "Redelivered Bitrix webhooks dropped", ["source"])
+DB_QUERY_SECONDS = Histogram("db_query_seconds", "SQL statement time", ["op"],
+                             buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+
+
+class QueueCollector:
+    """
+    Глубина metrika_queue и возраст самого старого queued-события.
+    Запрос кэшируется на QUEUE_STATS_TTL, чтобы частые scrape не нагружали БД.
+    """
+
+    def __init__(self, ttl: float):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = None
+        self._at = 0.0
+
+    def _get(self) -> dict | None:
+        with self._lock:
+            if self._stats is None or time.monotonic() - self._at > self._ttl:
+                from app.db import conn, get_queue_stats  # app.db сам импортирует app.metrics
+                try:
+                    with conn() as c:
+                        self._stats = get_queue_stats(c)
+                except Exception as e:
+                    log.warning("queue_stats_failed", extra={"error": str(e)})
+                self._at = time.monotonic()
+            return self._stats
+
+    def describe(self):
+        # без describe() REGISTRY.register вызвал бы collect() (запрос в БД) прямо при импорте,
+        # пока app.db ещё не инициализирован
+        yield GaugeMetricFamily("metrika_queue_depth", "metrika_queue rows by status", labels=["status"])
+        yield GaugeMetricFamily("metrika_queue_oldest_queued_age_seconds", "Age of the oldest queued metrika_queue row")
+
+    def collect(self):
+        stats = self._get()
+        if not stats:
+            return
+        depth = GaugeMetricFamily("metrika_queue_depth", "metrika_queue rows by status", labels=["status"])
+        for status, n in stats["depth"].items():
+            depth.add_metric([status], n)
+        yield depth
+        yield GaugeMetricFamily("metrika_queue_oldest_queued_age_seconds",
+                                "Age of the oldest queued metrika_queue row", value=stats["oldest_queued_age"])
+
+
+queue_collector = QueueCollector(QUEUE_STATS_TTL)
+REGISTRY.register(queue_collector)
+
+
+def registry():
+    """Реестр для отдачи: в multiprocess-режиме — метрики всех процессов плюс глубина очереди."""
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return REGISTRY
+    reg = CollectorRegistry()
+    multiprocess.MultiProcessCollector(reg)
+    reg.register(queue_collector)
+    return reg
+
+
+def render() -> tuple[bytes, str]:
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
+
+
+def serve(port: int):
+    """Отдельный HTTP /metrics для процессов без FastAPI (app.worker)."""
+    start_http_server(port, registry=registry())
+    log.info("metrics_server_started", extra={"port": port, "multiprocess": bool(PROMETHEUS_MULTIPROC_DIR)})
@@ -1,17 +1,21 @@
 import os
-import time
-import requests, hashlib, json
+import hashlib, json
 from requests import exceptions
 from datetime import datetime, timezone
 from app.logger import get_logger
+from app.sessions import get_session
+from app.metrics import METRIKA_SEND_SECONDS
 
-MC_URL = "https://mc.yandex.ru/collect"
+MC_URL = os.getenv("METRIKA_COLLECT_URL", "https://mc.yandex.ru/collect")
 log = get_logger("app.metrika")
 
 METRIKA_MAX_ATTEMPTS = int(os.getenv("METRIKA_MAX_ATTEMPTS", "3"))
 
-def build_payload(counter_id: int, token: str, client_id: str, event_name: str, deal: dict, uf_value: str, extra_ep: dict | None = None):
-    ts = int(datetime.now(timezone.utc).timestamp())
+def build_payload(counter_id: int, token: str, client_id: str, event_name: str, deal: dict, uf_value: str,
+                  extra_ep: dict | None = None, ts: int | None = None):
+    """ts — время события (unix); по умолчанию текущее, бэкфилл передаёт дату закрытия сделки."""
+    if ts is None:
+        ts = int(datetime.now(timezone.utc).timestamp())
     payload = {
         "tid": counter_id,
         "cid": str(client_id),
@@ -35,30 +39,27 @@ def build_payload(counter_id: int, token: str, client_id: str, event_name: str,
     return payload
 
 def send(payload: dict):
-    for attempt in range(1, METRIKA_MAX_ATTEMPTS + 1):
-        try:
-            r = requests.post(MC_URL, data=payload, timeout=10)
-        except exceptions.RequestException as e:
-            if attempt == METRIKA_MAX_ATTEMPTS:
-                log.error("mp_failed",
-                          extra={"counter": payload.get("tid"), "event": payload.get("ea"), "deal": payload.get("ti"),
-                                 "error": str(e), "attempt": attempt})
-                raise
-            log.warning("mp_retry",
-                        extra={"counter": payload.get("tid"), "event": payload.get("ea"), "deal": payload.get("ti"),
-                               "error": str(e), "attempt": attempt})
-            time.sleep(2 ** (attempt - 1))
-            continue
-        try:
-            r.raise_for_status()
-            log.info("mp_sent",
-                     extra={"counter": payload.get("tid"), "event": payload.get("ea"), "deal": payload.get("ti")})
-            return True
-        except Exception as e:
-            log.error("mp_failed",
-                      extra={"counter": payload.get("tid"), "event": payload.get("ea"), "deal": payload.get("ti"),
-                             "error": str(e)})
-            raise
+    # адаптер сессии (app.sessions) повторяет с backoff только сетевые ошибки: POST не идемпотентен, поэтому
+    # 5xx не повторяется здесь — строка уходит на повтор очереди (app.worker, next_attempt_at)
+    try:
+        with METRIKA_SEND_SECONDS.labels(str(payload.get("tid"))).time():
+            r = get_session("metrika", METRIKA_MAX_ATTEMPTS).post(MC_URL, data=payload, timeout=10)
+    except exceptions.RequestException as e:
+        log.error("mp_failed",
+                  extra={"counter": payload.get("tid"), "event": payload.get("ea"), "deal": payload.get("ti"),
+                         "error": str(e), "attempt": METRIKA_MAX_ATTEMPTS})
+        raise
+    try:
+        r.raise_for_status()
+        log.info("mp_sent",
+                 extra={"counter": payload.get("tid"), "event": payload.get("ea"), "deal": payload.get("ti")})
+        return True
+    except Exception as e:
+        log.error("mp_failed",
+                  extra={"counter": payload.get("tid"), "event": payload.get("ea"), "deal": payload.get("ti"),
+                         "error": str(e)})
+        raise
 def payload_hash(payload: dict) -> str:
-    s = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    # et — время формирования, не содержание события: иначе два одновременных webhook дают разные хэши
+    s = json.dumps({k: v for k, v in payload.items() if k != "et"}, sort_keys=True, ensure_ascii=False)
     return hashlib.sha256(s.encode("utf-8")).hexdigest()
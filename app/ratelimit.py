@@ -0,0 +1,91 @@
+import time
+import threading
+from app.logger import get_logger
+
+log = get_logger("app.ratelimit")
+
+
+class TokenBucket:
+    """
+    Token bucket с очередью: каждый вызов acquire() резервирует токен (баланс может уйти в минус)
+    и спит до своего слота — вызовы не падают, а ждут в порядке поступления.
+    Адаптивный: throttled() вдвое снижает скорость, после recover_sec без ошибок скорость
+    плавно (на 10% от max в секунду) возвращается к максимальной.
+    """
+
+    def __init__(self, rate: float, burst: float, min_rate: float, recover_sec: float = 10.0):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min(min_rate, rate)
+        self.recover_sec = recover_sec
+        self._tokens = burst
+        self._at = time.monotonic()         # последнее пополнение локального баланса
+        self._rate_at = self._at            # последний шаг восстановления скорости
+        self._throttled_at = 0.0
+        self._lock = threading.Lock()
+
+    def _recover(self, now: float):
+        if self.rate < self.max_rate and now - self._throttled_at > self.recover_sec:
+            step = self.max_rate * 0.1 * min(now - self._rate_at, 1.0)
+            self.rate = min(self.max_rate, self.rate + step)
+        self._rate_at = now
+
+    def reserve(self) -> float:
+        """Резервирует токен и возвращает, сколько секунд ждать (без сна — для asyncio.sleep)."""
+        with self._lock:
+            now = time.monotonic()
+            self._recover(now)
+            self._tokens = min(self.burst, self._tokens + (now - self._at) * self.rate) - 1
+            self._at = now
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def acquire(self) -> float:
+        """Блокирует до получения токена; возвращает время ожидания в секундах."""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self):
+        with self._lock:
+            self._throttled_at = time.monotonic()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 0.0)
+        log.warning("rate_limit_slowdown", extra={"rate": round(self.rate, 3)})
+
+    def stats(self) -> dict:
+        return {"rate": round(self.rate, 3), "max_rate": self.max_rate, "tokens": round(self._tokens, 2)}
+
+
+class DbTokenBucket(TokenBucket):
+    """
+    Тот же bucket, но баланс токенов общий для всех процессов — строка в bitrix_rate_limit.
+    Локальный баланс (унаследованный) трогается только при недоступной БД и пополняется сам по себе.
+    """
+
+    def __init__(self, name: str, rate: float, burst: float, min_rate: float, recover_sec: float = 10.0):
+        super().__init__(rate, burst, min_rate, recover_sec)
+        self.name = name
+        self.shared_tokens: float | None = None
+
+    def reserve(self) -> float:
+        from app.db import conn, take_rate_token
+        with self._lock:
+            self._recover(time.monotonic())
+            rate = self.rate
+        try:
+            with conn() as c:
+                tokens = take_rate_token(c, self.name, rate, self.burst)
+        except Exception as e:
+            # БД недоступна — не блокируем Битрикс, считаем по локальному bucket
+            log.warning("rate_limit_db_failed", extra={"error": str(e)})
+            return super().reserve()
+        self.shared_tokens = tokens
+        return -tokens / rate if tokens < 0 else 0.0
+
+    def stats(self) -> dict:
+        st = super().stats()
+        if self.shared_tokens is not None:
+            st["shared_tokens"] = round(self.shared_tokens, 2)
+        return st
@@ -8,3 +8,6 @@ if __name__ == "__main__":
 
     print("Binding onCrmDealAdd:", event_bind("onCrmDealAdd", settings.event_handler_url))
     print("Binding onCrmDealUpdate:", event_bind("onCrmDealUpdate", settings.event_handler_url))
+    # сброс кэша контактов (app.logic.invalidate_contact)
+    print("Binding onCrmContactUpdate:", event_bind("onCrmContactUpdate", settings.event_handler_url))
+    print("Binding onCrmContactDelete:", event_bind("onCrmContactDelete", settings.event_handler_url))
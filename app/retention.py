@@ -0,0 +1,74 @@
+"""
+Ретеншн metrika_queue: отправленные строки старше N дней переносятся в metrika_queue_archive
+(без payload) и удаляются из очереди небольшими пачками, каждая — отдельной короткой транзакцией:
+    python -m app.retention [--days 30] [--batch 1000] [--pause 0.2] [--max-batches 0] [--optimize]
+Запускать по cron; в конце печатает размер таблиц до/после и число перенесённых строк.
+"""
+import os
+import time
+import argparse
+from sqlalchemy import text
+from app.db import conn, engine, archive_sent_batch, get_table_sizes
+from app.logger import configure_root, get_logger
+
+configure_root("retention.log")
+log = get_logger("app.retention")
+
+QUEUE_RETENTION_DAYS = int(os.getenv("QUEUE_RETENTION_DAYS", "30"))
+QUEUE_RETENTION_BATCH = int(os.getenv("QUEUE_RETENTION_BATCH", "1000"))
+TABLES = ["metrika_queue", "metrika_queue_archive"]
+
+
+def run(days: int, batch: int, pause: float = 0.2, max_batches: int = 0) -> int:
+    moved = batches = 0
+    log.info("retention_started", extra={"days": days, "batch": batch})
+    while not max_batches or batches < max_batches:
+        with conn() as c:
+            n = archive_sent_batch(c, days, batch)
+        if not n:
+            break
+        moved += n
+        batches += 1
+        log.info("retention_batch", extra={"moved": moved, "batches": batches})
+        # пауза между пачками — даём воркерам и репликам догнать
+        time.sleep(pause)
+    log.info("retention_done", extra={"moved": moved, "batches": batches})
+    return moved
+
+
+def optimize():
+    """Возвращает освободившееся место ОС (InnoDB сам файл не сжимает); online DDL, но пишет всю таблицу заново."""
+    with engine.connect() as c:
+        c.execute(text("OPTIMIZE TABLE metrika_queue"))
+
+
+def _fmt(sizes: dict) -> str:
+    return ", ".join(f"{name}: ~{s['rows']} rows, data {s['data_bytes'] // 1048576} MiB, "
+                     f"index {s['index_bytes'] // 1048576} MiB, free {s['free_bytes'] // 1048576} MiB"
+                     for name, s in sizes.items())
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Archive old sent rows from metrika_queue")
+    ap.add_argument("--days", type=int, default=QUEUE_RETENTION_DAYS, help="хранить отправленные N дней")
+    ap.add_argument("--batch", type=int, default=QUEUE_RETENTION_BATCH, help="строк в одной транзакции")
+    ap.add_argument("--pause", type=float, default=0.2, help="пауза между пачками, с")
+    ap.add_argument("--max-batches", type=int, default=0, help="ограничить число пачек за запуск (0 — без лимита)")
+    ap.add_argument("--optimize", action="store_true", help="после переноса выполнить OPTIMIZE TABLE metrika_queue")
+    args = ap.parse_args()
+
+    with conn() as c:
+        before = get_table_sizes(c, TABLES)
+    moved = run(args.days, args.batch, args.pause, args.max_batches)
+    if args.optimize and moved:
+        optimize()
+    with conn() as c:
+        after = get_table_sizes(c, TABLES)
+    log.info("retention_report", extra={"moved": moved, "before": before, "after": after})
+    print(f"archived: {moved}")
+    print(f"before: {_fmt(before)}")
+    print(f"after:  {_fmt(after)}")
+
+
+if __name__ == "__main__":
+    main()
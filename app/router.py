@@ -1,20 +1,49 @@
+import os
 import time
 import threading
 
-from app.db import conn, get_routing_map
+from app.db import conn, get_routing_map, get_routing_version
+from app.routing_index import RoutingIndex
 from app.settings import settings
 from app.logger import get_logger
 
 log = get_logger("app.router")
 
+ROUTING_REFRESH_SEC = int(os.getenv("ROUTING_REFRESH_SEC", "300"))
+# пока ни одна загрузка не удалась (БД недоступна при старте) — повторяем чаще
+ROUTING_RETRY_SEC = int(os.getenv("ROUTING_RETRY_SEC", "5"))
+# версия (MAX(updated_at), COUNT(*)) секундная: правка в ту же секунду, что и прошлый снимок, её не меняет —
+# раз в ROUTING_FULL_RELOAD_SEC перечитываем таблицу без сравнения версий
+ROUTING_FULL_RELOAD_SEC = int(os.getenv("ROUTING_FULL_RELOAD_SEC", "1800"))
+
+
 class Router:
-    def __init__(self):
-        self._cache = {}
-        self._loaded_at = 0
-        self._lock = threading.Lock()
+    """
+    Таблица маршрутизации — неизменяемый снимок, который фоновый поток подменяет целиком.
+    pick() не ходит в БД (кроме самой первой загрузки); если БД недоступна,
+    продолжаем работать на последнем успешно загруженном снимке.
+    """
+
+    def __init__(self, interval: int = ROUTING_REFRESH_SEC):
+        self._index = RoutingIndex({})
+        self._version = None
+        self._loaded_at = 0  # последняя успешная проверка/загрузка
+        self._full_at = 0    # последняя полная загрузка
+        self._interval = interval
+        self._lock = threading.Lock()  # сериализует перезагрузки, чтение снимка — без блокировки
+        self._thread = None
 
-    def refresh(self):
+    def refresh(self, force: bool = False) -> bool:
+        with self._lock:
+            return self._refresh_locked(force)
+
+    def _refresh_locked(self, force: bool) -> bool:
         with conn() as c:
+            version = get_routing_version(c)
+            full_due = time.time() - self._full_at >= ROUTING_FULL_RELOAD_SEC
+            if not force and not full_due and self._loaded_at and version == self._version:
+                self._loaded_at = time.time()
+                return False
             dbm = get_routing_map(c)
         envm = {}
         for item in settings.metrika_routing_json:
@@ -23,17 +52,45 @@ class Router:
                 "mp_token": item["mp_token"]
             }
         dbm.update(envm)
+        self._index = RoutingIndex(dbm)
+        self._version = version
+        self._loaded_at = self._full_at = time.time()
+        log.info("routing_refreshed", extra={"count": len(dbm), "indexed": len(self._index)})
+        return True
+
+    def start(self):
+        if self._thread is not None:
+            return
         with self._lock:
-            self._cache = dbm
-            self._loaded_at = time.time()
-        log.info("routing_refreshed", extra={"count": len(self._cache)})
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name="routing-refresh")
+                self._thread.start()
 
-    def pick(self, uf_value: str):
+    def _run(self):
+        while True:
+            time.sleep(self._interval if self._loaded_at else ROUTING_RETRY_SEC)
+            try:
+                self.refresh()
+            except Exception as e:
+                log.warning("routing_refresh_failed", extra={"error": str(e), "age_sec": int(self.age())})
+
+    def route_count(self) -> int:
+        return len(self._index)
+
+    def age(self) -> float:
+        return time.time() - self._loaded_at if self._loaded_at else float("inf")
+
+    def ensure_loaded(self):
+        if self._loaded_at:
+            return
         with self._lock:
-            need_refresh = time.time() - self._loaded_at > 300
-        if need_refresh:
-            self.refresh()
-        route = self._cache.get((uf_value or "").strip().lower())
+            if not self._loaded_at:
+                self._refresh_locked(force=True)
+
+    def pick(self, uf_value: str):
+        self.ensure_loaded()
+        self.start()
+        route = self._index.lookup(uf_value or "")
         if not route:
             log.warning("routing_miss", extra={"uf_value": uf_value})
         return route
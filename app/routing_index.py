@@ -0,0 +1,76 @@
+from urllib.parse import urlparse
+
+
+def _label_to_unicode(label: str) -> str:
+    if label.startswith("xn--"):
+        try:
+            return label.encode("ascii").decode("idna")
+        except Exception:
+            return label
+    return label
+
+
+def normalize_host(val: str) -> str:
+    """
+    Приводит значение поля/ключ маршрутизации к каноничному host:
+    без схемы, пути, порта, 'www.' и точки на конце; punycode -> Unicode (сайт.рф == xn--80aswg.xn--p1ai).
+    Префикс '*.' (wildcard) сохраняется.
+    """
+    if not val:
+        return ""
+    s = val.strip().lower()
+    wildcard = s.startswith("*.")
+    if wildcard:
+        s = s[2:]
+    if "://" not in s:
+        s = "https://" + s
+    try:
+        host = urlparse(s).hostname or ""
+    except Exception:
+        return ""
+    host = host.rstrip(".")
+    if host.startswith("www."):
+        host = host[4:]
+    host = ".".join(_label_to_unicode(label) for label in host.split(".") if label)
+    if not host:
+        return ""
+    return "*." + host if wildcard else host
+
+
+class RoutingIndex:
+    """
+    Индекс маршрутов по суффиксу домена (ключ — кортеж меток в обратном порядке).
+    Поиск: точное совпадение -> самый длинный подходящий суффикс; O(число меток).
+    'example.com' подходит для example.com и любых поддоменов, '*.example.com' — только для поддоменов.
+    """
+
+    def __init__(self, routes: dict[str, dict]):
+        self._exact: dict[tuple, dict] = {}
+        self._wild: dict[tuple, dict] = {}
+        for key, route in routes.items():
+            host = normalize_host(key)
+            if not host:
+                continue
+            if host.startswith("*."):
+                self._wild[tuple(reversed(host[2:].split(".")))] = route
+            else:
+                self._exact[tuple(reversed(host.split(".")))] = route
+
+    def __len__(self):
+        return len(self._exact) + len(self._wild)
+
+    def lookup(self, value: str) -> dict | None:
+        host = normalize_host(value)
+        if not host or host.startswith("*."):
+            return None
+        labels = tuple(reversed(host.split(".")))
+        route = self._exact.get(labels)
+        if route:
+            return route
+        # от длинного суффикса к короткому; сам host уже проверен выше
+        for n in range(len(labels) - 1, 0, -1):
+            suffix = labels[:n]
+            route = self._wild.get(suffix) or self._exact.get(suffix)
+            if route:
+                return route
+        return None
@@ -0,0 +1,106 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from app.logger import get_logger
+
+log = get_logger("app.sessions")
+
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "1"))
+
+_sessions: dict[str, requests.Session] = {}
+_session_attempts: dict[str, int] = {}
+_async_clients: dict = {}
+_lock = threading.Lock()
+
+
+def _make_session(max_attempts: int, pool_size: int) -> requests.Session:
+    # повторяем только сетевые ошибки (как раньше ручные циклы по RequestException); повтор по HTTP-статусу
+    # для POST опасен — crm.contact.add или хит Метрики могли уже выполниться. Статусы повторяет
+    # вызывающий код и только для чтений (см. bitrix.bx_call)
+    retry = Retry(
+        total=max(max_attempts - 1, 0),
+        connect=max(max_attempts - 1, 0),
+        read=max(max_attempts - 1, 0),
+        status=0,
+        backoff_factor=HTTP_BACKOFF,  # 1 с, 2 с, ... — как раньше в ручных циклах
+        allowed_methods=None,  # POST тоже повторяем на сетевых ошибках — раньше так же делали bx_call/send
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    s = requests.Session()
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
+def get_session(name: str, max_attempts: int = 3, pool_size: int | None = None) -> requests.Session:
+    """
+    Общая keep-alive сессия для клиента (bitrix/metrika).
+    Размер пула на хост: <NAME>_POOL_SIZE, иначе HTTP_POOL_SIZE.
+    requests.Session + HTTPAdapter безопасны для параллельных запросов из разных потоков.
+    """
+    s = _sessions.get(name)
+    if s is None:
+        with _lock:
+            s = _sessions.get(name)
+            if s is None:
+                if pool_size is None:
+                    pool_size = int(os.getenv(f"{name.upper()}_POOL_SIZE", str(HTTP_POOL_SIZE)))
+                s = _make_session(max_attempts, pool_size)
+                _sessions[name] = s
+                _session_attempts[name] = max_attempts
+                log.info("http_session_created",
+                         extra={"client": name, "pool_size": pool_size, "max_attempts": max_attempts})
+    # сессия одна на имя: кто создал её первым, тот и задал повторы — другой набор молча не игнорируем
+    if _session_attempts[name] != max_attempts:
+        raise ValueError(f"http session '{name}' already created with max_attempts={_session_attempts[name]}")
+    return s
+
+
+def get_async_client(name: str, max_attempts: int = 3, timeout: float = 20, pool_size: int | None = None):
+    """
+    Общий httpx.AsyncClient для асинхронного пути (app.bitrix_async).
+    Транспорт повторяет только ошибки соединения; повторы по статусам — в вызывающем коде.
+    """
+    import httpx
+    client = _async_clients.get(name)
+    if client is None or client.is_closed:
+        if pool_size is None:
+            pool_size = int(os.getenv(f"{name.upper()}_POOL_SIZE", str(HTTP_POOL_SIZE)))
+        client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            transport=httpx.AsyncHTTPTransport(retries=max(max_attempts - 1, 0)),
+        )
+        _async_clients[name] = client
+        log.info("http_async_client_created", extra={"client": name, "pool_size": pool_size})
+    return client
+
+
+async def close_async_clients():
+    for client in list(_async_clients.values()):
+        await client.aclose()
+    _async_clients.clear()
+
+
+def pool_stats() -> dict[str, dict]:
+    """Статистика переиспользования соединений: запросов vs открытых соединений по хостам."""
+    out = {}
+    for name, s in list(_sessions.items()):
+        hosts = {}
+        for adapter in set(s.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                hosts[f"{pool.scheme}://{pool.host}"] = {
+                    "requests": pool.num_requests,
+                    "connections": pool.num_connections,
+                    "reused": max(pool.num_requests - pool.num_connections, 0),
+                }
+        out[name] = hosts
+    return out
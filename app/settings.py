@@ -22,6 +22,9 @@ class Settings(BaseModel):
     uf_required: str = os.getenv("UF_REQUIRED", "UF_CRM_SITE")
     uf_client_id_contact: str | None = os.getenv("UF_CLIENT_ID_CONTACT") or None
 
+    # доп. поля сделки для проекции crm.deal.list (через запятую) — к тому, что код читает сам
+    deal_select_extra: list[str] = [s.strip() for s in os.getenv("DEAL_SELECT_EXTRA", "").split(",") if s.strip()]
+
     paid_stages: list[str] = [s.strip() for s in os.getenv("PAID_STAGES", "").split(",") if s.strip()]
     cancelled_stages: list[str] = [s.strip() for s in os.getenv("CANCELLED_STAGES", "").split(",") if s.strip()]
 
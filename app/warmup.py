@@ -0,0 +1,112 @@
+"""
+Прогрев при старте: пул БД, таблица маршрутизации, enum-кэши и keep-alive соединения к Битриксу/Метрике
+параллельно, с замером каждого шага. Результат — для /ready; фоновые потоки (воркер, ingest)
+стартуют после прогрева.
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from app.settings import settings
+from app import bitrix as bx
+from app.db import conn, ping, warm_pool
+from app.router import router
+from app.metrika import MC_URL, METRIKA_MAX_ATTEMPTS
+from app.sessions import get_session
+from app.logger import get_logger
+
+log = get_logger("app.warmup")
+
+WARMUP_TIMEOUT_SEC = float(os.getenv("WARMUP_TIMEOUT_SEC", "30"))
+# для /ready: маршруты должны были обновляться не реже чем раз в N секунд
+READY_ROUTING_MAX_AGE_SEC = float(os.getenv("READY_ROUTING_MAX_AGE_SEC", "900"))
+
+state = {"started": False, "done": False, "duration_ms": None, "steps": {}}
+
+
+def _warm_db():
+    return {"connections": warm_pool()}
+
+
+def _warm_router():
+    # фоновый refresh — в любом случае: если первая загрузка упала, только он её и повторит
+    router.start()
+    router.refresh(force=True)
+    return {"routes": router.route_count()}
+
+
+def _warm_enums():
+    codes = [c for c in (settings.uf_routing_field, settings.uf_required) if c]
+    bx.enum_cache.preload(codes)
+    missing = [c for c in codes if c not in bx.enum_cache]
+    if missing:
+        raise RuntimeError(f"enum fields not loaded: {missing}")
+    return {"fields": codes}
+
+
+def _warm_http(name: str, url: str, max_attempts: int):
+    # любой ответ подходит: нужно открыть TLS-соединение в пуле сессии, а не проверить API
+    def step():
+        r = get_session(name, max_attempts).head(url, timeout=5)
+        return {"status": r.status_code}
+    return step
+
+
+STEPS = {
+    "db_pool": _warm_db,
+    "router": _warm_router,
+    "enums": _warm_enums,
+    "bitrix_http": _warm_http("bitrix", settings.bitrix_webhook_url or "", bx.BITRIX_MAX_ATTEMPTS),
+    "metrika_http": _warm_http("metrika", MC_URL, METRIKA_MAX_ATTEMPTS),
+}
+
+
+def _timed(name: str, fn):
+    started = time.perf_counter()
+    try:
+        info = {"ok": True, **(fn() or {})}
+    except Exception as e:
+        info = {"ok": False, "error": str(e)}
+    info["ms"] = int((time.perf_counter() - started) * 1000)
+    state["steps"][name] = info
+    log.info("warmup_step", extra={"step": name, **info})
+    return info
+
+
+def run() -> dict:
+    """Все шаги параллельно; ошибка шага не мешает остальным и старту приложения."""
+    state["started"] = True
+    started = time.perf_counter()
+    pool = ThreadPoolExecutor(max_workers=len(STEPS), thread_name_prefix="warmup")
+    futures = [pool.submit(_timed, name, fn) for name, fn in STEPS.items()]
+    deadline = time.monotonic() + WARMUP_TIMEOUT_SEC
+    for f in futures:
+        try:
+            f.result(timeout=max(deadline - time.monotonic(), 0))
+        except Exception:
+            pass  # зависший шаг не держит старт; его итог допишется в state, когда (если) завершится
+    pool.shutdown(wait=False)
+    state["duration_ms"] = int((time.perf_counter() - started) * 1000)
+    state["done"] = True
+    log.info("warmup_done", extra={"duration_ms": state["duration_ms"],
+                                   "failed": [n for n, s in state["steps"].items() if not s.get("ok")]})
+    return state
+
+
+def readiness() -> tuple[bool, dict]:
+    """Прогрев закончен, БД отвечает, маршруты загружены и не устарели."""
+    checks = {}
+    started = time.perf_counter()
+    try:
+        with conn() as c:
+            ping(c)
+        checks["db"] = {"ok": True, "ms": int((time.perf_counter() - started) * 1000)}
+    except Exception as e:
+        checks["db"] = {"ok": False, "error": str(e)}
+    routing_age = router.age()
+    checks["router"] = {"ok": routing_age <= READY_ROUTING_MAX_AGE_SEC,
+                        "age_sec": None if routing_age == float("inf") else int(routing_age),
+                        "routes": router.route_count()}
+    checks["enums"] = {code: (None if bx.enum_cache.age(code) is None else int(bx.enum_cache.age(code)))
+                       for code in (settings.uf_routing_field, settings.uf_required) if code}
+    ready = state["done"] and checks["db"]["ok"] and checks["router"]["ok"]
+    return ready, {"ready": ready, "warmup": state, "checks": checks}
@@ -1,11 +1,35 @@
+import os
+import sys
+import random
 import time, json
-from app.db import conn, fetch_queue_batch, mark_sent, mark_error, get_deal_state, update_last_hash
-from app.metrika import send, payload_hash
+import socket
+import threading
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+from app.db import conn, claim_queue_batch, mark_sent, mark_error
+from app.metrika import send
+from app import metrics
 from app.logger import get_logger, configure_root
 
 configure_root("worker.log")
 log = get_logger("app.worker")
 
+# сколько сделок отправляем параллельно и сколько одновременных запросов на один счётчик (tid)
+METRIKA_WORKERS = int(os.getenv("METRIKA_WORKERS", "1"))
+METRIKA_PER_COUNTER = int(os.getenv("METRIKA_PER_COUNTER", "4"))
+METRIKA_LEASE_SEC = int(os.getenv("METRIKA_LEASE_SEC", "300"))
+# повторная отправка после ошибки: base * 2^(n-1) с джиттером, не больше cap; после max попыток — 'dead'
+METRIKA_RETRY_MAX = int(os.getenv("METRIKA_RETRY_MAX", "8"))
+METRIKA_RETRY_BASE_SEC = float(os.getenv("METRIKA_RETRY_BASE_SEC", "10"))
+METRIKA_RETRY_CAP_SEC = float(os.getenv("METRIKA_RETRY_CAP_SEC", "3600"))
+# порт /metrics отдельного процесса отправки (0 — не поднимать); при N > 1 нужен PROMETHEUS_MULTIPROC_DIR
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "0"))
+
+_counter_slots: dict = {}
+_slots_lock = threading.Lock()
+
+
 def _as_dict(val):
     if isinstance(val, (dict, list)):
         return val
@@ -14,31 +38,98 @@ def _as_dict(val):
     except Exception:
         return val
 
+
+def _counter_slot(tid) -> threading.BoundedSemaphore:
+    with _slots_lock:
+        sem = _counter_slots.get(tid)
+        if sem is None:
+            sem = _counter_slots[tid] = threading.BoundedSemaphore(METRIKA_PER_COUNTER)
+        return sem
+
+
+def _retry_delay(attempts: int) -> float | None:
+    """attempts — сколько попыток уже сделано вместе с текущей."""
+    if attempts >= METRIKA_RETRY_MAX:
+        return None
+    delay = min(METRIKA_RETRY_BASE_SEC * 2 ** (attempts - 1), METRIKA_RETRY_CAP_SEC)
+    return max(1.0, delay * random.uniform(0.5, 1.0))
+
+
+def _send_item(item) -> bool:
+    try:
+        payload = _as_dict(item["payload"])
+        with _counter_slot(payload.get("tid") if isinstance(payload, dict) else None):
+            send(payload)
+        # deal_state.last_sent_hash уже записан при постановке в очередь — здесь только статус строки
+        with conn() as c2:
+            mark_sent(c2, item["id"])
+        log.info("event_sent", extra={"queue_id": item["id"], "deal_id": item["deal_id"], "type": item["event_type"]})
+        return True
+    except Exception as e:
+        attempts = int(item.get("attempts") or 0) + 1
+        retry_in = _retry_delay(attempts)
+        with conn() as c3:
+            mark_error(c3, item["id"], str(e), retry_in)
+        if retry_in is None:
+            log.error("event_dead", extra={"queue_id": item["id"], "deal_id": item["deal_id"],
+                                           "attempts": attempts, "error": str(e)})
+        else:
+            log.error("event_send_failed", extra={"queue_id": item["id"], "error": str(e),
+                                                  "attempts": attempts, "retry_in": int(retry_in)})
+        return False
+
+
+def _send_deal_chain(items: list):
+    # события одной сделки уходят строго в порядке очереди; после ошибки остальные ждут следующего прохода
+    for n, item in enumerate(items):
+        if not _send_item(item):
+            if n + 1 < len(items):
+                log.warning("deal_chain_stopped", extra={"deal_id": item["deal_id"], "left": len(items) - n - 1})
+            return
+
+
+def _worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
 def worker_loop():
-    log.info("worker_started")
+    worker_id = _worker_id()
+    log.info("worker_started", extra={"worker_id": worker_id, "workers": METRIKA_WORKERS,
+                                      "per_counter": METRIKA_PER_COUNTER})
+    pool = ThreadPoolExecutor(max_workers=max(METRIKA_WORKERS, 1), thread_name_prefix="metrika-send")
     while True:
         try:
             with conn() as c:
-                batch = fetch_queue_batch(c, limit=50)
+                batch = claim_queue_batch(c, worker_id, limit=50, lease_sec=METRIKA_LEASE_SEC)
             if not batch:
                 time.sleep(2)
                 continue
+            by_deal = defaultdict(list)
             for item in batch:
-                try:
-                    payload = _as_dict(item["payload"])
-                    send(payload)
-                    with conn() as c2:
-                        mark_sent(c2, item["id"])
-                        h = payload_hash(payload if isinstance(payload, dict) else {})
-                        st = get_deal_state(c2, item["deal_id"])
-                        if st:
-                            update_last_hash(c2, item["deal_id"], h)
-                    log.info("event_sent", extra={"queue_id": item["id"], "deal_id": item["deal_id"], "type": item["event_type"]})
-                except Exception as e:
-                    with conn() as c3:
-                        mark_error(c3, item["id"], str(e))
-                    log.error("event_send_failed", extra={"queue_id": item["id"], "error": str(e)})
-                    time.sleep(0.5)
+                by_deal[item["deal_id"]].append(item)
+            wait([pool.submit(_send_deal_chain, items) for items in by_deal.values()])
         except Exception:
             log.exception("worker_loop_error")
             time.sleep(2)
+
+
+if __name__ == "__main__":
+    # отдельный процесс(ы) отправки: python -m app.worker [N]
+    # (в этом случае в app.main выставьте RUN_WORKER=false)
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else int(os.getenv("WORKER_PROCESSES", "1"))
+    if n <= 1:
+        if WORKER_METRICS_PORT:
+            metrics.serve(WORKER_METRICS_PORT)
+        worker_loop()
+    else:
+        procs = [multiprocessing.Process(target=worker_loop, name=f"metrika-worker-{i}") for i in range(n)]
+        for p in procs:
+            p.start()
+        # сервер — в родителе после fork: сам он ничего не отправляет, метрики дочерних берёт из файлов
+        if WORKER_METRICS_PORT:
+            if not metrics.PROMETHEUS_MULTIPROC_DIR:
+                log.warning("worker_metrics_single_process",
+                            extra={"processes": n, "hint": "set PROMETHEUS_MULTIPROC_DIR"})
+            metrics.serve(WORKER_METRICS_PORT)
+        for p in procs:
+            p.join()
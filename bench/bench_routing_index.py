@@ -0,0 +1,54 @@
+"""
+Бенчмарк поиска маршрута: python -m bench.bench_routing_index [число_маршрутов]
+Сравнивает RoutingIndex (суффиксы + IDNA) с прежним точным поиском по dict.
+"""
+import sys
+import time
+import random
+
+from app.routing_index import RoutingIndex, normalize_host
+
+
+def _routes(n: int) -> dict[str, dict]:
+    routes = {}
+    for i in range(n):
+        key = f"https://site{i}.example{i % 50}.ru" if i % 10 else f"*.brand{i}.рф"
+        routes[key] = {"counter_id": i, "mp_token": f"t{i}"}
+    return routes
+
+
+def _queries(n: int, count: int) -> list[str]:
+    rnd = random.Random(42)
+    out = []
+    for _ in range(count):
+        i = rnd.randrange(n)
+        out.append(rnd.choice([f"site{i}.example{i % 50}.ru", f"m.site{i}.example{i % 50}.ru",
+                               f"shop.brand{i}.рф", f"nohit{i}.com"]))
+    return out
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    routes = _routes(n)
+    queries = _queries(n, 200000)
+
+    t0 = time.perf_counter()
+    index = RoutingIndex(routes)
+    build = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    hits = sum(1 for q in queries if index.lookup(q))
+    idx_time = time.perf_counter() - t0
+
+    flat = {k.strip().lower(): v for k, v in routes.items()}
+    t0 = time.perf_counter()
+    flat_hits = sum(1 for q in queries if flat.get(normalize_host(q)))
+    flat_time = time.perf_counter() - t0
+
+    print(f"routes: {n}, queries: {len(queries)}, build: {build * 1000:.1f} ms")
+    print(f"RoutingIndex: {idx_time / len(queries) * 1e6:.2f} us/lookup, hits {hits}")
+    print(f"exact dict:   {flat_time / len(queries) * 1e6:.2f} us/lookup, hits {flat_hits}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Локальные заглушки Bitrix REST и Metrika collect для нагрузочных тестов.
+Задержка и доля ошибок настраиваются; все обращения считаются.
+"""
+import re
+import json
+import time
+import random
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qsl
+
+_KEY_RE = re.compile(r"\[([^\]]*)\]")
+_REF_RE = re.compile(r"\$result\[(\w+)\]((?:\[\w+\])*)")
+
+
+def _php_parse(query: str) -> dict:
+    """Обратное к bitrix._php_query: fields[PHONE][0][VALUE]=... -> вложенный dict."""
+    out: dict = {}
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        head = key.split("[", 1)[0]
+        path = [head] + _KEY_RE.findall(key[len(head):])
+        node = out
+        for part in path[:-1]:
+            node = node.setdefault(part, {})
+        node[path[-1]] = value
+    return out
+
+
+def _resolve_ref(value, path: list[str]):
+    for part in path:
+        if isinstance(value, list):
+            value = value[int(part)] if part.isdigit() and int(part) < len(value) else None
+        elif isinstance(value, dict):
+            value = value.get(part)
+        else:
+            return ""
+    return "" if value is None else value
+
+
+class FakeBitrix:
+    def __init__(self, latency: float = 0.05, error_rate: float = 0.0, paid_stage: str = "WON",
+                 routing_field: str = "UF_CRM_BRAND", required_field: str = "UF_CRM_SITE", hosts: int = 20):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.paid_stage = paid_stage
+        self.routing_field = routing_field
+        self.required_field = required_field
+        self.hosts = hosts
+        self.http_calls = 0
+        self.methods = Counter()
+        self._lock = threading.Lock()
+        self._next_contact = 10_000_000
+        self._links: dict[int, int] = {}
+
+    def deal(self, deal_id: int) -> dict:
+        stages = ["NEW", "PREPARATION", "EXECUTING", self.paid_stage]
+        d = {
+            "ID": str(deal_id), "TITLE": f"Deal {deal_id}", "STAGE_ID": stages[deal_id % len(stages)],
+            "OPPORTUNITY": "1000.00", "CURRENCY_ID": "RUB", "client_id": f"cid{deal_id}",
+            "CONTACT_ID": str(deal_id + 100_000) if deal_id % 3 else None,
+            self.routing_field: f"https://site{deal_id % self.hosts}.example.ru/",
+            self.required_field: "yes",
+            "PHONE": [{"VALUE": f"+7900{deal_id:07d}"}],
+        }
+        if deal_id in self._links:
+            d["CONTACT_ID"] = str(self._links[deal_id])
+        return d
+
+    def _call(self, method: str, params: dict):
+        with self._lock:
+            self.methods[method] += 1
+        if method == "crm.deal.get":
+            return self.deal(int(params["id"]))
+        if method == "crm.deal.list":
+            deal_id = int((params.get("filter") or {}).get("ID") or 0)
+            select = list((params.get("select") or {}).values()) if isinstance(params.get("select"), dict) \
+                else params.get("select") or ["*"]
+            d = self.deal(deal_id)
+            return [d if "*" in select else {k: v for k, v in d.items() if k in select}] if deal_id else []
+        if method == "crm.contact.get":
+            if not params.get("id"):
+                raise KeyError("ID is not defined or invalid")
+            cid = int(params["id"])
+            return {"ID": str(cid), "PHONE": [{"VALUE": f"+7911{cid:07d}"}], "EMAIL": []}
+        if method == "crm.duplicate.findbycomm":
+            return {}
+        if method == "crm.contact.list":
+            return []
+        if method == "crm.contact.add":
+            with self._lock:
+                self._next_contact += 1
+                return self._next_contact
+        if method == "crm.deal.update":
+            self._links[int(params["id"])] = int((params.get("fields") or {}).get("CONTACT_ID") or 0)
+            return True
+        if method == "crm.deal.userfield.get":
+            return {"LIST": []}
+        raise KeyError(f"Method not found: {method}")
+
+    def _batch(self, params: dict) -> dict:
+        results, errors = {}, {}
+        for key, cmd in (params.get("cmd") or {}).items():
+            cmd = _REF_RE.sub(lambda m: str(_resolve_ref(results.get(m.group(1)), _KEY_RE.findall(m.group(2)))), cmd)
+            method, _, query = cmd.partition("?")
+            try:
+                results[key] = self._call(method, _php_parse(query))
+            except Exception as e:
+                errors[key] = {"error": "ERROR", "error_description": str(e)}
+                if str(params.get("halt")) == "1":
+                    break
+        return {"result": results, "result_error": errors}
+
+    def handle(self, path: str, body: bytes) -> tuple[int, dict]:
+        with self._lock:
+            self.http_calls += 1
+        time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            return 503, {"error": "QUERY_LIMIT_EXCEEDED", "error_description": "Too many requests"}
+        method = path.rstrip("/").rsplit("/", 1)[-1].removesuffix(".json")
+        params = json.loads(body or b"{}")
+        try:
+            if method == "batch":
+                return 200, {"result": self._batch(params)}
+            return 200, {"result": self._call(method, params)}
+        except Exception as e:
+            return 400, {"error": "ERROR", "error_description": str(e)}
+
+
+class FakeMetrika:
+    def __init__(self, latency: float = 0.02, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.hits = 0
+        self.first_at = None
+        self.last_at = None
+        self._lock = threading.Lock()
+
+    def handle(self, path: str, body: bytes) -> tuple[int, dict]:
+        time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            return 500, {"error": "fake"}
+        with self._lock:
+            self.hits += 1
+            now = time.monotonic()
+            self.first_at = self.first_at or now
+            self.last_at = now
+        return 200, {}
+
+
+def serve(fake, port: int = 0) -> ThreadingHTTPServer:
+    """Поднимает заглушку в фоне; фактический порт — server.server_address[1]."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            status, data = fake.handle(self.path, body)
+            out = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,13 @@
+CREATE TABLE IF NOT EXISTS bitrix_inbound (
+  id           BIGINT AUTO_INCREMENT PRIMARY KEY,
+  event        VARCHAR(64) NOT NULL,
+  deal_id      BIGINT NOT NULL,
+  status       VARCHAR(16) NOT NULL DEFAULT 'queued',
+  attempts     INT NOT NULL DEFAULT 0,
+  last_error   TEXT NULL,
+  received_at  TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+  claimed_at   TIMESTAMP NULL,
+  processed_at TIMESTAMP NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE INDEX IF NOT EXISTS bitrix_inbound_status_idx ON bitrix_inbound(status, id);
@@ -0,0 +1,5 @@
+ALTER TABLE metrika_queue
+  ADD COLUMN IF NOT EXISTS claimed_by  VARCHAR(128) NULL,
+  ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP NULL;
+
+CREATE INDEX IF NOT EXISTS metrika_queue_deal_status_idx ON metrika_queue(deal_id, status, id);
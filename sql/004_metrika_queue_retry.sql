@@ -0,0 +1,8 @@
+ALTER TABLE metrika_queue
+  ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP;
+
+-- опрос воркера: status='queued' AND next_attempt_at <= NOW() ORDER BY id — range scan по индексу
+CREATE INDEX IF NOT EXISTS metrika_queue_poll_idx ON metrika_queue(status, next_attempt_at, id);
+
+-- старые 'error' больше не используются: неотправленные после всех попыток лежат как 'dead'
+UPDATE metrika_queue SET status='dead' WHERE status='error';
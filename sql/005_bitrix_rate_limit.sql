@@ -0,0 +1,6 @@
+-- общий token bucket для нескольких процессов (BITRIX_RATE_MODE=db)
+CREATE TABLE IF NOT EXISTS bitrix_rate_limit (
+  name       VARCHAR(64) PRIMARY KEY,
+  tokens     DOUBLE NOT NULL,
+  updated_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
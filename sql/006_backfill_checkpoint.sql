@@ -0,0 +1,7 @@
+CREATE TABLE IF NOT EXISTS backfill_checkpoint (
+  name       VARCHAR(64) PRIMARY KEY,
+  last_id    BIGINT NOT NULL DEFAULT 0,
+  processed  BIGINT NOT NULL DEFAULT 0,
+  queued     BIGINT NOT NULL DEFAULT 0,
+  updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -0,0 +1,15 @@
+-- компактный архив отправленных событий: без payload/last_error, только то, что нужно для разборов
+CREATE TABLE IF NOT EXISTS metrika_queue_archive (
+  id          BIGINT PRIMARY KEY,
+  deal_id     BIGINT NOT NULL,
+  event_type  VARCHAR(32) NOT NULL,
+  counter_id  BIGINT NULL,
+  attempts    INT NOT NULL DEFAULT 0,
+  created_at  TIMESTAMP NOT NULL,
+  sent_at     TIMESTAMP NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE INDEX IF NOT EXISTS metrika_queue_archive_deal_idx ON metrika_queue_archive(deal_id);
+
+-- выборка для ретеншна: status='sent' AND sent_at < :cutoff ORDER BY sent_at — range scan без прохода по таблице
+CREATE INDEX IF NOT EXISTS metrika_queue_sent_idx ON metrika_queue(status, sent_at);
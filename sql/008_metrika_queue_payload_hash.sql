@@ -0,0 +1,13 @@
+-- payload_hash — хэш содержимого события (без et), хранится всегда;
+-- dedup_hash = payload_hash, пока строка ждёт отправки: уникальный ключ по нему отсекает параллельную
+-- постановку того же события (INSERT IGNORE). mark_sent/'dead' обнуляют dedup_hash — после отправки
+-- то же событие можно поставить снова (оплата -> отмена -> оплата). NULL в уникальном индексе не конфликтует.
+ALTER TABLE metrika_queue
+  ADD COLUMN IF NOT EXISTS payload_hash CHAR(64) NULL,
+  ADD COLUMN IF NOT EXISTS dedup_hash   CHAR(64) NULL;
+
+DROP INDEX IF EXISTS metrika_queue_dedup_uq ON metrika_queue;
+CREATE UNIQUE INDEX IF NOT EXISTS metrika_queue_pending_uq ON metrika_queue(deal_id, event_type, dedup_hash);
+
+ALTER TABLE metrika_queue_archive
+  ADD COLUMN IF NOT EXISTS payload_hash CHAR(64) NULL;
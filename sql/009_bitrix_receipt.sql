@@ -0,0 +1,8 @@
+-- отпечатки принятых webhook (sha256 от event/сделки/ts/токена) для отсечения повторных доставок Битрикса;
+-- строки старше окна дедупликации чистит сам app.dedup
+CREATE TABLE IF NOT EXISTS bitrix_receipt (
+  receipt_key CHAR(64) PRIMARY KEY,
+  created_at  TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+CREATE INDEX IF NOT EXISTS bitrix_receipt_created_idx ON bitrix_receipt(created_at);
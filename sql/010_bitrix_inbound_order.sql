@@ -0,0 +1,5 @@
+-- claim_inbound_batch: NOT EXISTS по более раннему незавершённому событию сделки
+CREATE INDEX IF NOT EXISTS bitrix_inbound_deal_status_idx ON bitrix_inbound(deal_id, status, id);
+
+-- очистка обработанных: status='done' AND processed_at < ...
+CREATE INDEX IF NOT EXISTS bitrix_inbound_done_idx ON bitrix_inbound(status, processed_at);
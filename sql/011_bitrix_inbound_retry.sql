@@ -0,0 +1,5 @@
+ALTER TABLE bitrix_inbound
+  ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP;
+
+-- claim_inbound_batch: status='queued' AND next_attempt_at <= NOW() ORDER BY id
+CREATE INDEX IF NOT EXISTS bitrix_inbound_poll_idx ON bitrix_inbound(status, next_attempt_at, id);
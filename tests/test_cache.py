@@ -0,0 +1,76 @@
+import pytest
+from app import cache
+from app.cache import TTLCache
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    t = FakeTime()
+    monkeypatch.setattr(cache, "time", t)
+    return t
+
+
+def test_get_set_and_expiry(clock):
+    c = TTLCache("test_expiry", 10, ttl=5)
+    c.set("a", 1)
+    assert c.get("a") == 1
+    clock.now += 6
+    assert c.get("a") is None
+    assert c.get("a", "dflt") == "dflt"
+    st = c.stats()
+    assert st["hits"] == 1 and st["misses"] == 2 and st["size"] == 0
+
+
+def test_per_key_ttl(clock):
+    c = TTLCache("test_per_key_ttl", 10, ttl=5)
+    c.set("a", 1, ttl=60)
+    clock.now += 30
+    assert c.get("a") == 1
+
+
+def test_lru_eviction(clock):
+    c = TTLCache("test_lru", 2, ttl=60)
+    c.set("a", 1)
+    c.set("b", 2)
+    c.get("a")  # b — самый давний
+    c.set("c", 3)
+    assert c.get("b") is None
+    assert c.get("a") == 1 and c.get("c") == 3
+    assert c.stats()["evictions"] == 1
+
+
+def test_compute(clock):
+    c = TTLCache("test_compute", 10, ttl=5)
+    assert c.compute("a", lambda cur: None) is None
+    assert c.get("a") is None
+    assert c.compute("a", lambda cur: (cur or 0) + 1) == 1
+    assert c.compute("a", lambda cur: (cur or 0) + 1) == 2
+    assert c.compute("a", lambda cur: None) is None
+    assert c.get("a") == 2  # None — значение не меняется
+    clock.now += 6
+    # просроченное значение fn не видит
+    assert c.compute("a", lambda cur: "fresh" if cur is None else "stale") == "fresh"
+
+
+def test_pop_and_pop_values(clock):
+    c = TTLCache("test_pop", 10, ttl=60)
+    c.set("phone", 42)
+    c.set("email", 42)
+    c.set("other", 7)
+    assert c.pop("other") == 7
+    assert c.pop("other") is None
+    assert c.pop_values(42) == 2
+    assert len(c) == 0
+
+
+def test_cache_stats_registry():
+    TTLCache("test_registry", 1, ttl=1)
+    assert "test_registry" in cache.cache_stats()
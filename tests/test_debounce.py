@@ -0,0 +1,94 @@
+import time
+import threading
+from app.debounce import Coalescer
+
+
+def wait_until(pred, timeout: float = 3.0) -> bool:
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if pred():
+            return True
+        time.sleep(0.005)
+    return pred()
+
+
+class Recorder:
+    def __init__(self, fail_times: int = 0, sleep: float = 0.0):
+        self.calls = []
+        self.fail_times = fail_times
+        self.sleep = sleep
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, key):
+        with self._lock:
+            self.calls.append(key)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            fail = len(self.calls) <= self.fail_times
+        try:
+            if self.sleep:
+                time.sleep(self.sleep)
+            if fail:
+                raise RuntimeError("boom")
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+def test_burst_collapses_into_one_call():
+    fn = Recorder()
+    co = Coalescer(fn, delay=0.05, max_wait=1.0)
+    for _ in range(5):
+        co.submit(1)
+    co.submit(2)
+    assert wait_until(lambda: len(fn.calls) == 2)
+    time.sleep(0.1)
+    assert sorted(fn.calls) == [1, 2]
+    st = co.stats()
+    assert st["received"] == 6 and st["collapsed"] == 4 and st["fired"] == 2
+
+
+def test_max_wait_bounds_the_delay():
+    fn = Recorder()
+    co = Coalescer(fn, delay=0.1, max_wait=0.15)
+    start = time.monotonic()
+    # события чаще delay — без max_wait вызов откладывался бы всё время
+    while time.monotonic() - start < 0.5 and not fn.calls:
+        co.submit(1)
+        time.sleep(0.02)
+    assert fn.calls
+    assert time.monotonic() - start < 0.45
+
+
+def test_same_key_never_runs_concurrently():
+    fn = Recorder(sleep=0.15)
+    co = Coalescer(fn, delay=0.01, max_wait=0.01)
+    co.submit(1)
+    assert wait_until(lambda: fn.active == 1)
+    co.submit(1)
+    assert wait_until(lambda: len(fn.calls) == 2)
+    assert wait_until(lambda: fn.active == 0)
+    assert fn.max_active == 1
+
+
+def test_failed_call_is_retried_with_backoff():
+    fn = Recorder(fail_times=2)
+    co = Coalescer(fn, delay=0.01, max_wait=0.01, retry_max=5, retry_base=0.01)
+    co.submit(7)
+    assert wait_until(lambda: len(fn.calls) == 3)
+    time.sleep(0.1)
+    assert fn.calls == [7, 7, 7]
+    st = co.stats()
+    assert st["retried"] == 2 and st["failed"] == 0
+
+
+def test_retries_stop_after_retry_max():
+    fn = Recorder(fail_times=100)
+    co = Coalescer(fn, delay=0.01, max_wait=0.01, retry_max=2, retry_base=0.01)
+    co.submit(7)
+    assert wait_until(lambda: co.stats()["failed"] == 1)
+    time.sleep(0.1)
+    assert len(fn.calls) == 3  # первый вызов + 2 повтора
+    assert co.stats()["pending"] == 0
@@ -0,0 +1,85 @@
+import pytest
+from app import dedup
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    t = FakeTime()
+    monkeypatch.setattr(dedup, "time", t)
+    dedup._seen.clear()
+    dedup._inflight.clear()
+    yield t
+    dedup._seen.clear()
+    dedup._inflight.clear()
+
+
+def test_redelivery_after_processing_started_next_second_is_dropped(clock):
+    ts = int(clock.now) - 1
+    assert dedup.seen_local("k", ts) is False
+    assert dedup.finish("k") is False
+    assert dedup.seen_local("k", ts) is True
+
+
+def test_same_second_update_after_finish_is_rerun(clock):
+    # первая доставка начала обработку в ту же секунду ts — второе изменение этой секунды она могла не видеть
+    ts = int(clock.now)
+    assert dedup.seen_local("k", ts) is False
+    assert dedup.finish("k") is False
+    clock.now += 0.5
+    assert dedup.seen_local("k", ts) is False
+    assert dedup.finish("k") is False
+    # повторный прогон начался в секунду ts+1 — дальнейшие повторы уже лишние
+    clock.now += 1
+    assert dedup.seen_local("k", ts) is False
+    dedup.finish("k")
+    assert dedup.seen_local("k", ts) is True
+
+
+def test_duplicate_during_processing_requests_rerun(clock):
+    ts = int(clock.now)
+    assert dedup.seen_local("k", ts) is False
+    assert dedup.seen_local("k", ts) is True
+    assert dedup.finish("k") is True   # прогнать ещё раз
+    assert dedup.finish("k") is False
+
+
+def test_duplicate_during_processing_started_later_is_dropped(clock):
+    ts = int(clock.now) - 2
+    assert dedup.seen_local("k", ts) is False
+    assert dedup.seen_local("k", ts) is True
+    assert dedup.finish("k") is False
+
+
+def test_without_ts_identical_body_is_dropped(clock):
+    assert dedup.seen_local("k") is False
+    dedup.finish("k")
+    assert dedup.seen_local("k") is True
+
+
+def test_forget_lets_redelivery_through(clock, monkeypatch):
+    monkeypatch.setattr(dedup, "WEBHOOK_DEDUP_DB", False)
+    ts = int(clock.now) - 5
+    assert dedup.seen_local("k", ts) is False
+    dedup.forget("k")
+    assert dedup.seen_local("k", ts) is False
+
+
+def test_receipt_key_depends_on_ts_and_token():
+    base = {"ts": "1700000000", "auth": {"application_token": "a"}}
+    k = dedup.receipt_key("onCrmDealUpdate", 1, base)
+    assert k == dedup.receipt_key("onCrmDealUpdate", 1, dict(base))
+    assert k != dedup.receipt_key("onCrmDealUpdate", 1, {**base, "ts": "1700000001"})
+    assert k != dedup.receipt_key("onCrmDealUpdate", 2, base)
+    assert dedup.event_ts(base) == 1700000000
+    assert dedup.event_ts({}) is None
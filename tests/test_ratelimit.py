@@ -0,0 +1,122 @@
+from contextlib import contextmanager
+import pytest
+from app import ratelimit
+from app.ratelimit import TokenBucket, DbTokenBucket
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, sec):
+        self.now += sec
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    t = FakeTime()
+    monkeypatch.setattr(ratelimit, "time", t)
+    return t
+
+
+def test_burst_then_queued_waits(clock):
+    b = TokenBucket(rate=2, burst=3, min_rate=0.5)
+    assert [b.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert b.reserve() == pytest.approx(0.5)
+    assert b.reserve() == pytest.approx(1.0)
+
+
+def test_refill_over_time(clock):
+    b = TokenBucket(rate=2, burst=3, min_rate=0.5)
+    for _ in range(3):
+        b.reserve()
+    clock.now += 0.5
+    assert b.reserve() == 0.0
+    clock.now += 10
+    # баланс не копится выше burst
+    assert [b.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert b.reserve() > 0
+
+
+def test_acquire_sleeps_for_its_slot(clock):
+    b = TokenBucket(rate=2, burst=1, min_rate=0.5)
+    assert b.acquire() == 0.0
+    start = clock.now
+    assert b.acquire() == pytest.approx(0.5)
+    assert clock.now - start == pytest.approx(0.5)
+
+
+def test_throttled_halves_rate_down_to_min_and_recovers(clock):
+    b = TokenBucket(rate=2, burst=3, min_rate=0.5, recover_sec=10)
+    b.throttled()
+    assert b.rate == 1
+    b.throttled()
+    b.throttled()
+    assert b.rate == 0.5
+    clock.now += 5
+    b.reserve()
+    assert b.rate == 0.5  # recover_sec после ошибки ещё не прошли
+    clock.now += 6
+    b.reserve()
+    assert b.rate > 0.5
+    for _ in range(20):
+        clock.now += 1
+        b.reserve()
+    assert b.rate == 2
+
+
+def _db_down(monkeypatch):
+    import app.db
+
+    @contextmanager
+    def conn():
+        raise ConnectionError("db is down")
+        yield
+
+    monkeypatch.setattr(app.db, "conn", conn)
+
+
+def test_db_bucket_uses_shared_balance(clock, monkeypatch):
+    import app.db
+
+    @contextmanager
+    def conn():
+        yield None
+
+    monkeypatch.setattr(app.db, "conn", conn)
+    monkeypatch.setattr(app.db, "take_rate_token", lambda c, name, rate, burst: -1.0)
+    b = DbTokenBucket("bitrix", rate=2, burst=3, min_rate=0.5)
+    assert b.reserve() == pytest.approx(0.5)
+    assert b.stats()["shared_tokens"] == -1.0
+    assert b.stats()["tokens"] == 3  # локальный баланс не тронут
+
+
+def test_db_bucket_fallback_refills_when_db_is_down(clock, monkeypatch):
+    _db_down(monkeypatch)
+    b = DbTokenBucket("bitrix", rate=2, burst=3, min_rate=0.5)
+    # 1.67 req/s при лимите 2 req/s — ждать не нужно ни разу
+    waits = []
+    for _ in range(30):
+        waits.append(b.reserve())
+        clock.now += 0.6
+    assert waits == [0.0] * 30
+
+
+def test_db_bucket_fallback_after_db_calls(clock, monkeypatch):
+    import app.db
+
+    @contextmanager
+    def conn():
+        yield None
+
+    monkeypatch.setattr(app.db, "conn", conn)
+    monkeypatch.setattr(app.db, "take_rate_token", lambda c, name, rate, burst: 0.0)
+    b = DbTokenBucket("bitrix", rate=2, burst=3, min_rate=0.5)
+    for _ in range(10):
+        b.reserve()
+        clock.now += 0.6
+    _db_down(monkeypatch)
+    assert b.reserve() == 0.0
@@ -0,0 +1,46 @@
+import pytest
+from app.routing_index import RoutingIndex, normalize_host
+
+
+@pytest.mark.parametrize("raw, host", [
+    ("example.com", "example.com"),
+    ("  HTTPS://WWW.Example.COM:8443/path?q=1 ", "example.com"),
+    ("shop.example.com.", "shop.example.com"),
+    ("xn--80aswg.xn--p1ai", "сайт.рф"),
+    ("https://www.xn--80aswg.xn--p1ai/", "сайт.рф"),
+    ("*.Example.com", "*.example.com"),
+    ("", ""),
+    ("https://", ""),
+])
+def test_normalize_host(raw, host):
+    assert normalize_host(raw) == host
+
+
+def test_lookup_exact_and_suffix():
+    idx = RoutingIndex({"example.com": {"counter_id": 1}, "shop.example.com": {"counter_id": 2}})
+    assert idx.lookup("example.com")["counter_id"] == 1
+    assert idx.lookup("https://www.example.com/x")["counter_id"] == 1
+    assert idx.lookup("a.b.example.com")["counter_id"] == 1
+    # самый длинный подходящий суффикс
+    assert idx.lookup("eu.shop.example.com")["counter_id"] == 2
+    assert idx.lookup("example.org") is None
+    assert idx.lookup("notexample.com") is None
+
+
+def test_wildcard_matches_only_subdomains():
+    idx = RoutingIndex({"*.example.com": {"counter_id": 3}})
+    assert idx.lookup("a.example.com")["counter_id"] == 3
+    assert idx.lookup("example.com") is None
+
+
+def test_punycode_and_unicode_keys_are_the_same():
+    idx = RoutingIndex({"сайт.рф": {"counter_id": 4}})
+    assert idx.lookup("xn--80aswg.xn--p1ai")["counter_id"] == 4
+    assert len(idx) == 1
+
+
+def test_invalid_keys_and_values_are_ignored():
+    idx = RoutingIndex({"": {"counter_id": 5}})
+    assert len(idx) == 0
+    assert idx.lookup("") is None
+    assert idx.lookup("*.example.com") is None